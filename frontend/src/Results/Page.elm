@@ -25,7 +25,7 @@ type Msg
     | GotScanList (Result (Error String) ( Metadata, List ScanInfo ))
     | ViewScanner
     | ReplayScan String
-    | GotReplayScan (Result (Error String) ( Metadata, Int ))
+    | GotReplayScan (Result (Error String) ( Metadata, String ))
     | DownloadResult String
     | DownloadAllResults
 
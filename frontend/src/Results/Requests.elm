@@ -17,11 +17,11 @@ getAllScans m =
         }
 
 
-replayScan : (Result (Error String) ( Metadata, Int ) -> msg) -> String -> Cmd msg
+replayScan : (Result (Error String) ( Metadata, String ) -> msg) -> String -> Cmd msg
 replayScan m resultId =
     let
         resultDecoder =
-            D.field "vnc_port" D.int
+            D.field "container_id" D.string
     in
     Http.post
         { url = managerApi "replay_scan"
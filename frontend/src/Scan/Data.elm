@@ -6,11 +6,20 @@ import String exposing (fromInt)
 
 
 type alias ContainerStartInfo =
-    { vnc_port : Int
+    { vnc_host : String
+    , vnc_port : Int
     , container_id : String
     }
 
 
+containerStartInfoDecoder : Decoder ContainerStartInfo
+containerStartInfoDecoder =
+    D.map3 ContainerStartInfo
+        (D.field "vnc_host" D.string)
+        (D.field "vnc_port" D.int)
+        (D.field "container_id" D.string)
+
+
 type LogLevel
     = Info
     | Warning
@@ -123,6 +132,7 @@ stateToString status =
 type ScanUpdate
     = NoOp
     | SocketInit String
+    | ScanStarted ContainerStartInfo
     | ScanComplete
     | SocketError String
     | Log String
@@ -139,6 +149,9 @@ scanUpdateToString update =
         SocketInit _ ->
             "SocketInit"
 
+        ScanStarted _ ->
+            "ScanStarted"
+
         ScanComplete ->
             "ScanComplete"
 
@@ -199,9 +212,17 @@ scanUpdateFromDict ( k, v ) =
         "SocketInit" ->
             Just (SocketInit v)
 
+        "ScanStarted" ->
+            D.decodeString containerStartInfoDecoder v
+                |> Result.toMaybe
+                |> Maybe.map ScanStarted
+
         "ScanComplete" ->
             Just ScanComplete
 
+        "QueuePosition" ->
+            Just (Log ("All browsers busy, waiting in queue (position " ++ v ++ ")."))
+
         "GuacamoleMsg" ->
             Just (GuacamoleMsg v)
 
@@ -33,7 +33,8 @@ type alias Model =
 
 
 type alias Connection =
-    { vncPort : Int
+    { vncHost : String
+    , vncPort : Int
     , containerId : String
     }
 
@@ -42,7 +43,7 @@ type Msg
     = UpdateUrlInput String
     | SetGuacamoleFocus Bool
     | StartScan
-    | GotStartScan (Result (Error String) ( Metadata, ContainerStartInfo ))
+    | GotStartScan (Result (Error String) ( Metadata, String ))
     | ConnectToGuacamole Connection
     | ReceiveScanUpdate ScanUpdate
     | UpdateNoteInput String
@@ -116,7 +117,8 @@ update msg model =
             ( appendLogEntry { msg = "Connecting to Guacamole...", level = Data.Info } model
             , Ports.connectTunnel <|
                 E.object
-                    [ ( "vncPort", E.int connection.vncPort )
+                    [ ( "vncHost", E.string connection.vncHost )
+                    , ( "vncPort", E.int connection.vncPort )
                     , ( "containerId", E.string connection.containerId )
                     ]
             )
@@ -203,21 +205,13 @@ finishScanCommands model =
     Cmd.batch [ finishCmd, Ports.disconnectTunnel () ]
 
 
-processStartResult : Model -> Result (Error String) ( Metadata, ContainerStartInfo ) -> ( Model, Cmd Msg )
+processStartResult : Model -> Result (Error String) ( Metadata, String ) -> ( Model, Cmd Msg )
 processStartResult model result =
     case result of
-        Ok ( _, containerInfo ) ->
-            let
-                connection =
-                    { vncPort = containerInfo.vnc_port
-                    , containerId = containerInfo.container_id
-                    }
-            in
-            ( updateScanState ScanInProgress
-                { model
-                    | connection = Just connection
-                }
-            , Delay.after 500 (ConnectToGuacamole connection)
+        Ok _ ->
+            -- the container is started in the background, see ScanStarted
+            ( appendLogEntry { msg = "Starting browser...", level = Data.Info } model
+            , Cmd.none
             )
 
         Err error ->
@@ -228,6 +222,23 @@ processStartResult model result =
             )
 
 
+startConnection : ContainerStartInfo -> Model -> ( Model, Cmd Msg )
+startConnection containerInfo model =
+    let
+        connection =
+            { vncHost = containerInfo.vnc_host
+            , vncPort = containerInfo.vnc_port
+            , containerId = containerInfo.container_id
+            }
+    in
+    ( updateScanState ScanInProgress
+        { model
+            | connection = Just connection
+        }
+    , Delay.after 500 (ConnectToGuacamole connection)
+    )
+
+
 processScanUpdate : ScanUpdate -> Model -> ( Model, Cmd Msg )
 processScanUpdate scanUpdate model =
     case ( scanUpdate, model.scanState ) of
@@ -237,6 +248,9 @@ processScanUpdate scanUpdate model =
         ( SocketInit id, Idle ) ->
             ( { model | socketId = Just id }, Cmd.none )
 
+        ( ScanStarted containerInfo, ConnectingToBrowser ) ->
+            startConnection containerInfo model
+
         ( ScanComplete, ScanInProgress ) ->
             ( updateScanState
                 AwaitingInteraction
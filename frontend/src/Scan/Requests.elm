@@ -6,16 +6,13 @@ import Http.Detailed exposing (Error, expectJson, expectWhatever)
 import Json.Decode as D
 import Json.Encode as E
 import Requests exposing (managerApi)
-import Scan.Data exposing (ContainerStartInfo)
 
 
-startScan : (Result (Error String) ( Metadata, ContainerStartInfo ) -> msg) -> String -> String -> Cmd msg
+startScan : (Result (Error String) ( Metadata, String ) -> msg) -> String -> String -> Cmd msg
 startScan m scanUrl socketToken =
     let
         resultDecoder =
-            D.map2 ContainerStartInfo
-                (D.field "vnc_port" D.int)
-                (D.field "container_id" D.string)
+            D.field "scan_handle" D.string
     in
     Http.post
         { url = managerApi "start_scan"
@@ -82,7 +82,7 @@ app.ports.connectTunnel.subscribe(function (connection) {
 });
 
 function connectGuacamole(connection) {
-    param = "port=" + connection.vncPort.toString()
+    param = "hostname=" + encodeURIComponent(connection.vncHost) + "&port=" + connection.vncPort.toString()
     client.connect(param);
 }
 
@@ -1,6 +1,11 @@
 package de.uniba.psi;
 
+import java.util.Arrays;
+import java.util.Set;
+import java.util.stream.Collectors;
+import javax.servlet.ServletException;
 import javax.servlet.http.HttpServletRequest;
+import org.apache.guacamole.GuacamoleClientException;
 import org.apache.guacamole.GuacamoleException;
 import org.apache.guacamole.net.GuacamoleSocket;
 import org.apache.guacamole.net.GuacamoleTunnel;
@@ -12,13 +17,45 @@ import org.apache.guacamole.servlet.GuacamoleHTTPTunnelServlet;
 
 public class GuacamoleTunnelServlet extends GuacamoleHTTPTunnelServlet {
 
+    // VNC hosts the tunnel may connect to, see init-param allowed-hosts in web.xml
+    private Set<String> allowedHosts;
+
+    @Override
+    public void init() throws ServletException {
+        super.init();
+        String hosts = getInitParameter("allowed-hosts");
+        allowedHosts = Arrays.stream((hosts != null ? hosts : "localhost").split(","))
+                .map(String::trim)
+                .filter(host -> !host.isEmpty())
+                .collect(Collectors.toSet());
+    }
+
     @Override
     protected GuacamoleTunnel doConnect(HttpServletRequest request) throws GuacamoleException {
+        // VNC host is the podman host the container was placed on (see manager/podman_container.py),
+        // only the configured podman hosts are accepted, the tunnel must not connect to arbitrary hosts
+        String hostname = request.getParameter("hostname");
+        if (hostname == null) {
+            hostname = "localhost";
+        }
+        if (!allowedHosts.contains(hostname)) {
+            throw new GuacamoleClientException("VNC host " + hostname + " is not allowed.");
+        }
+        int port;
+        try {
+            port = Integer.parseInt(request.getParameter("port"));
+        } catch (NumberFormatException e) {
+            throw new GuacamoleClientException("Invalid VNC port.", e);
+        }
+        if (port < 1 || port > 65535) {
+            throw new GuacamoleClientException("Invalid VNC port " + port + ".");
+        }
+
         // Create our configuration
         GuacamoleConfiguration config = new GuacamoleConfiguration();
         config.setProtocol("vnc");
-        config.setParameter("hostname", "localhost");
-        config.setParameter("port", request.getParameter("port"));
+        config.setParameter("hostname", hostname);
+        config.setParameter("port", Integer.toString(port));
         config.setParameter("password", "asdf");
 
         // Connect to guacd - everything is hard-coded here.
@@ -0,0 +1,128 @@
+import math
+import os
+import time
+from collections import deque
+from threading import Condition
+
+import logs
+import metrics
+import podman_container
+from errors import AdmissionError
+
+# seconds a rejected client should wait per full round of scans ahead of it
+RETRY_AFTER = 30
+
+logger = logs.get_logger('admission')
+
+
+def host_capacity(cpus_per_scan, memory_per_scan):
+    """
+    Returns the number of concurrent scans the local host can run with the given per scan resources.
+    :param memory_per_scan: memory in bytes
+    """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    cpus = os.cpu_count() or 1
+    return max(1, min(int(cpus / cpus_per_scan), memory // memory_per_scan))
+
+
+def hosts_capacity(hosts, cpus_per_scan, memory_per_scan):
+    """
+    Returns the number of concurrent scans the podman hosts can run, i.e. the sum of their configured capacities.
+    The resources of remote hosts are unknown, the local host is additionally limited by its cpus and memory.
+    :param hosts: podman hosts (see podman_container.get_hosts)
+    :param memory_per_scan: memory in bytes
+    """
+    local_capacity = host_capacity(cpus_per_scan, memory_per_scan)
+    return max(1, sum(min(host.capacity, local_capacity) if host.name == podman_container.LOCAL_HOST
+                      else host.capacity for host in hosts))
+
+
+class Ticket:
+    pass
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent scans, further scans wait in a FIFO queue.
+
+    A scan enqueues a ticket, waits until it is admitted and releases its slot once the scan is complete.
+    """
+
+    def __init__(self, capacity, max_queue, max_wait):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active = 0
+        self._queue = deque()
+        self._condition = Condition()
+
+    def enqueue(self):
+        """
+        :raises AdmissionError: if the queue is full
+        """
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                raise AdmissionError('Too many scans waiting, please try again later.', self._retry_after())
+            ticket = Ticket()
+            self._queue.append(ticket)
+            return ticket
+
+    def position(self, ticket):
+        """
+        Returns the (1-based) queue position of a waiting ticket.
+        """
+        with self._condition:
+            return self._queue.index(ticket) + 1
+
+    def wait(self, ticket, timeout=None, on_position=None):
+        """
+        Blocks until the ticket is admitted.
+        :param timeout: max seconds to wait, defaults to max_wait (0 only admits without waiting)
+        :param on_position: called with the queue position whenever it changes
+        :raises AdmissionError: if the ticket was not admitted in time
+        The ticket is removed from the queue whenever it is not admitted, including errors raised by on_position.
+        """
+        start = time.monotonic()
+        deadline = start + (self.max_wait if timeout is None else timeout)
+        last_position = None
+        admitted = False
+        try:
+            while True:
+                with self._condition:
+                    if self._queue[0] is ticket and self._active < self.capacity:
+                        self._queue.popleft()
+                        self._active += 1
+                        admitted = True
+                        # the next ticket might be admitted as well
+                        self._condition.notify_all()
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        raise AdmissionError('No free scanner available, please try again later.',
+                                             self._retry_after())
+                    position = self._queue.index(ticket) + 1
+                    if on_position is None or position == last_position:
+                        self._condition.wait(remaining)
+                        continue
+                # inform the client outside of the lock
+                on_position(position)
+                last_position = position
+        finally:
+            if not admitted:
+                # e.g. timeout or on_position failed, the tickets behind must not wait for this ticket
+                with self._condition:
+                    if ticket in self._queue:
+                        self._queue.remove(ticket)
+                    self._condition.notify_all()
+        metrics.record('admission_wait_seconds', time.monotonic() - start)
+        logger.debug(f'Scan admitted ({self._active}/{self.capacity} active, {len(self._queue)} waiting).')
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def _retry_after(self):
+        # one round of scans for every capacity sized block of waiting tickets
+        return RETRY_AFTER * math.ceil((len(self._queue) + 1) / self.capacity)
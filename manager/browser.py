@@ -1,9 +1,11 @@
 import asyncio
 
 import playwright.async_api as async_api
-from playwright.async_api import async_playwright
+from podman.errors import PodmanError
 
 import logs
+import playwright_driver
+import podman_container
 from errors import ScannerError
 
 logger = logs.get_logger('chrome_api')
@@ -18,28 +20,38 @@ MIN_SLEEP_TIME = 1
 DOCUMENT_LOADED_TIMEOUT = 10 * 1000
 # 5 seconds
 NETWORK_IDLE_TIMEOUT = 5 * 1000
-# 500 microseconds (2 kHz)
-PROFILER_SAMPLING_INTERVAL = 500
 
 
 class Browser:
-    def __init__(self, debugging_port, files_path):
-        ip = "localhost"
-        self._debugger_url = "http://{}:{}".format(ip, debugging_port)
+    def __init__(self, address, debugging_port, files_path, ready=False):
+        """
+        :param ready: the devtools endpoint already responded (e.g. containers probed by run_container)
+        """
+        self._address = address
+        self._debugging_port = debugging_port
+        self._ready = ready
+        self._debugger_url = "http://{}:{}".format(address, debugging_port)
         self.files_path = files_path
 
     async def __aenter__(self):
-        await self._await_browser()
+        if not self._ready:
+            await self._await_browser()
 
-        # Create Browser
-        self._playwright = await async_playwright().start()
-        chromium = self._playwright.chromium
-        self._browser = await chromium.connect_over_cdp(self._debugger_url)
+        # Connect to Browser through the shared playwright driver
+        self._browser = await playwright_driver.connect_over_cdp(self._debugger_url)
+        try:
+            await self._create_page()
+        except BaseException:
+            try:
+                await self._browser.close()
+            finally:
+                await playwright_driver.release(self._browser)
+            raise
+        return self
 
-        # Create Context (like incognito session)
-        har_path = self.files_path / 'network.har'
-        self._context = await self._browser.new_context(accept_downloads=False, record_har_path=har_path,
-                                                        record_har_omit_content=True)
+    async def _create_page(self):
+        # Create Context (like incognito session), the HAR files are written by the scanner (see har_writer)
+        self._context = await self._browser.new_context(accept_downloads=False)
 
         # Create Tab
         self._page = await self._context.new_page()
@@ -50,17 +62,23 @@ class Browser:
         # CDP session
         self._cdp_session = await self._context.new_cdp_session(self._page)
         await self.set_dom_breakpoints()
-        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._context.close()
-        await self._browser.close()
-        await self._playwright.stop()
-        logger.warning('playwright stopped')
-
-    async def _await_browser(self, timeout=10000):
-        # TODO improve
-        await asyncio.sleep(3)
+        try:
+            await self._context.close()
+            await self._browser.close()
+        finally:
+            await playwright_driver.release(self._browser)
+        logger.warning('browser disconnected')
+
+    async def _await_browser(self):
+        # see podman_container.wait_until_ready
+        try:
+            ready_time = await asyncio.to_thread(podman_container.wait_until_ready,
+                                                 self._address, self._debugging_port)
+        except PodmanError as e:
+            raise ScannerError(f'{e}, scan aborted.') from e
+        logger.info(f'Browser ready after {ready_time:.2f} seconds.')
 
     async def set_dom_breakpoints(self):
         setEventBreakpoint = "DOMDebugger.setEventListenerBreakpoint"
@@ -85,9 +103,6 @@ class Browser:
     async def get_cookies(self):
         return await self._context.cookies()
 
-    async def get_cookies1(self, url):
-        return await self._context.cookies([url])
-
     async def clear_cookies(self):
         await self._context.clear_cookies()
 
@@ -119,9 +134,12 @@ class Browser:
             case default:
                 raise ScannerError(f"Unknown event '{default}', scan aborted.")
 
-    async def start_profiler(self):
+    async def start_profiler(self, sampling_interval):
+        """
+        :param sampling_interval: in microseconds (see ScannerOptions)
+        """
         await self.cdp_send_message("Profiler.enable")
-        await self.cdp_send_message("Profiler.setSamplingInterval", interval=PROFILER_SAMPLING_INTERVAL)
+        await self.cdp_send_message("Profiler.setSamplingInterval", interval=sampling_interval)
         await self.cdp_send_message("Profiler.start")
 
 
@@ -0,0 +1,164 @@
+import asyncio
+import json
+from itertools import chain, islice
+
+import logs
+
+logger = logs.get_logger('capture_buffer')
+
+# marks a reserved slot whose record will never be available (see discard)
+_DISCARDED = object()
+
+
+class CaptureBuffer:
+    """
+    Ordered list of serialized records (e.g. requests) with a memory ceiling.
+
+    Once the records in memory exceed the ceiling, the oldest slots are appended to a JSON lines file (one line per slot).
+    Slots can be reserved before their record is available (e.g. long-lived requests), open and discarded slots are
+    spilled as null. Records set after their slot was spilled are kept in memory and returned at the slot's position.
+    A reserved slot must therefore be either set or discarded.
+    A record must not change once it is set, it may be spilled at any time.
+
+    The buffer is used on the event loop of the scanner, the spill file is written and read in worker threads.
+    """
+
+    def __init__(self, spill_path, memory_limit):
+        self._spill_path = spill_path
+        self._memory_limit = memory_limit
+        # records in memory, None marks a reserved slot
+        self._records = []
+        # approximate size of the records in memory (length of their JSON representation)
+        self._size = 0
+        # slots removed from memory and slots written to the spill file
+        self._num_spilled = 0
+        self._num_written = 0
+        # slots removed from memory which are not written yet (in order, None for open or discarded slots),
+        # see _write_spilled
+        self._unwritten = []
+        # index -> record set after its slot was spilled
+        self._late = dict()
+        self._write_task = None
+        # set if the spill file could not be written, further records are kept in memory
+        self._write_failed = False
+
+    def __len__(self):
+        return self._num_spilled + len(self._records)
+
+    def append(self, record):
+        self.set(self.reserve(), record)
+
+    def reserve(self):
+        """
+        Reserves the slot for a record that is not available yet.
+        :return: index of the slot, see set()
+        """
+        self._records.append(None)
+        return len(self) - 1
+
+    def set(self, index, record):
+        if index < self._num_spilled:
+            self._late[index] = record
+            return
+        self._records[index - self._num_spilled] = record
+        self._size += len(json.dumps(record))
+        if self._size > self._memory_limit:
+            self._spill()
+
+    def discard(self, index):
+        """
+        Releases a reserved slot whose record will not be set, e.g. because it could not be serialized.
+        """
+        if index < self._num_spilled:
+            # spilled as null
+            return
+        self._records[index - self._num_spilled] = _DISCARDED
+
+    def records(self):
+        """
+        Returns the current records (see Records), the spill file must be kept until they are read.
+        """
+        in_memory = [record for record in self._records if record is not None and record is not _DISCARDED]
+        return Records(self._spill_path, self._num_written, list(self._unwritten), dict(self._late), in_memory)
+
+    async def discard_spilled(self):
+        """
+        Removes the spill file, e.g. once its records are stored in the result.
+        """
+        if self._write_task is not None:
+            await self._write_task
+        self._late.clear()
+        if self._num_written or self._write_failed:
+            await asyncio.to_thread(self._spill_path.unlink, missing_ok=True)
+
+    def _spill(self):
+        # spill down to half of the limit, otherwise every further record would trigger a write
+        target = self._memory_limit // 2
+        count = 0
+        for record in self._records:
+            if self._size <= target:
+                break
+            if record is None or record is _DISCARDED:
+                # open slots (e.g. long-lived requests) keep their record in memory once it is set
+                self._unwritten.append(None)
+            else:
+                self._unwritten.append(record)
+                self._size = max(0, self._size - len(json.dumps(record)))
+            count += 1
+        del self._records[:count]
+        self._num_spilled += count
+        if not self._write_failed and (self._write_task is None or self._write_task.done()):
+            self._write_task = asyncio.get_running_loop().create_task(self._write_spilled())
+
+    async def _write_spilled(self):
+        # records stay in _unwritten until they are written, records() returns them in the meantime
+        while self._unwritten:
+            batch = list(self._unwritten)
+            try:
+                await asyncio.to_thread(self._append_lines, batch)
+            except OSError as e:
+                logger.error(f'Could not spill records to {self._spill_path.name}, keeping them in memory: {e}')
+                self._write_failed = True
+                return
+            del self._unwritten[:len(batch)]
+            self._num_written += len(batch)
+            logger.debug(f'Spilled {len(batch)} records to {self._spill_path.name} ({self._num_written} in total).')
+
+    def _append_lines(self, records):
+        # open and discarded slots are written as null, line i is the slot with index i
+        with self._spill_path.open('a') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+
+
+class Records:
+    """
+    Snapshot of the records of a CaptureBuffer.
+
+    Spilled records are read from disk one by one while iterating, they are never loaded as a whole.
+    Iterating reads the spill file, it should therefore happen in a worker thread (e.g. while the journal is written).
+    Reserved slots without record are skipped.
+    """
+
+    def __init__(self, spill_path, num_written, unwritten, late, in_memory):
+        self._spill_path = spill_path
+        # the file is read up to the slots written when the snapshot was taken
+        self._num_written = num_written
+        self._unwritten = unwritten
+        self._late = late
+        self._in_memory = in_memory
+
+    def __iter__(self):
+        spilled = chain(self._read_spilled(), self._unwritten)
+        for index, record in enumerate(spilled):
+            if record is None:
+                record = self._late.get(index)
+            if record is not None:
+                yield record
+        yield from self._in_memory
+
+    def _read_spilled(self):
+        if not self._num_written:
+            return
+        with self._spill_path.open() as f:
+            for line in islice(f, self._num_written):
+                yield json.loads(line)
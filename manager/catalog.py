@@ -0,0 +1,202 @@
+import sqlite3
+import sys
+import time
+from contextlib import closing, contextmanager
+
+import config
+import logs
+
+# sqlite database listing all scans, rebuilt from the result folders with 'python catalog.py rebuild'
+# (only an empty catalog is rebuilt at startup, e.g. after result folders were added or removed by hand)
+CATALOG_PATH = config.storage.get('catalog_path', fallback='catalog.sqlite3')
+# seconds to wait for a lock held by another thread
+LOCK_TIMEOUT = 30
+# name of the run folder of the first scan (see result.FIRST_SCAN)
+FIRST_SCAN_RUN = 'first_scan'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id TEXT PRIMARY KEY,
+    site_url TEXT,
+    created REAL,
+    updated REAL,
+    -- success of the first scan, 1 while it is running
+    success INTEGER,
+    replay_count INTEGER NOT NULL DEFAULT 0,
+    -- bytes of all runs
+    size INTEGER NOT NULL DEFAULT 0,
+    -- increases with every change of the scan (or its runs)
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scans_created ON scans (created);
+CREATE INDEX IF NOT EXISTS scans_seq ON scans (seq);
+CREATE TABLE IF NOT EXISTS runs (
+    scan_id TEXT NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+    -- folder of the run (first_scan or recorded_scan_<n>)
+    name TEXT NOT NULL,
+    started REAL,
+    -- NULL while the run is active
+    finished REAL,
+    success INTEGER,
+    size INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scan_id, name)
+);
+-- last seq value, kept by clear() so that seq values are never reused
+CREATE TABLE IF NOT EXISTS counter (value INTEGER NOT NULL);
+INSERT INTO counter SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM counter);
+"""
+
+logger = logs.get_logger('catalog')
+
+
+@contextmanager
+def _connect():
+    # one connection per call, connections must not be shared between threads
+    with closing(sqlite3.connect(CATALOG_PATH, timeout=LOCK_TIMEOUT)) as connection:
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA foreign_keys = ON')
+        with connection:
+            yield connection
+
+
+def init():
+    """
+    Creates the catalog tables.
+    :return: True if the catalog contains no scan (e.g. it was just created)
+    """
+    with _connect() as connection:
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.executescript(SCHEMA)
+        return connection.execute('SELECT count(*) FROM scans').fetchone()[0] == 0
+
+
+def record_run(scan_id, run_name, site_url, started, finished=None, success=True, size=0, first_scan=False):
+    """
+    Inserts or updates a run and updates the summary of its scan.
+    :param first_scan: whether the run is the first scan (the runs of replays are counted as replays)
+    """
+    with _connect() as connection:
+        # lock the database before reading the seq counter
+        connection.execute('BEGIN IMMEDIATE')
+        _record_run(connection, scan_id, run_name, site_url, started, finished, success, size, first_scan)
+
+
+def replace(runs, keep_after):
+    """
+    Replaces the catalog by the runs in a single transaction, readers see either the old or the new catalog.
+    Scans updated after keep_after (i.e. by scans running while the runs were collected) keep their entries.
+    :param runs: list of dicts with the arguments of record_run
+    :return: number of scans in the catalog
+    """
+    with _connect() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        kept = {row['id'] for row in connection.execute('SELECT id FROM scans WHERE updated > ?', (keep_after,))}
+        connection.execute('DELETE FROM runs WHERE scan_id IN (SELECT id FROM scans WHERE updated <= ?)',
+                           (keep_after,))
+        connection.execute('DELETE FROM scans WHERE updated <= ?', (keep_after,))
+        for run in runs:
+            if run['scan_id'] not in kept:
+                _record_run(connection, **run)
+        return connection.execute('SELECT count(*) FROM scans').fetchone()[0]
+
+
+def _record_run(connection, scan_id, run_name, site_url, started, finished=None, success=True, size=0,
+                first_scan=False):
+    seq = _next_seq(connection)
+    connection.execute('INSERT INTO scans (id, site_url, created, updated, success, seq) VALUES (?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT (id) DO NOTHING',
+                       (scan_id, site_url, started, started, success, seq))
+    connection.execute('INSERT INTO runs (scan_id, name, started, finished, success, size) '
+                       'VALUES (?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT (scan_id, name) DO UPDATE SET finished = excluded.finished, '
+                       'success = excluded.success, size = excluded.size',
+                       (scan_id, run_name, started, finished, success, size))
+    if first_scan:
+        connection.execute('UPDATE scans SET site_url = ?, created = ?, success = ? WHERE id = ?',
+                           (site_url, started, success, scan_id))
+    connection.execute('UPDATE scans SET updated = ?, seq = ?, '
+                       'replay_count = (SELECT count(*) FROM runs WHERE scan_id = ? AND name != ?), '
+                       'size = (SELECT coalesce(sum(size), 0) FROM runs WHERE scan_id = ?) WHERE id = ?',
+                       (time.time(), seq, scan_id, FIRST_SCAN_RUN, scan_id, scan_id))
+
+
+def scan_exists(scan_id):
+    with _connect() as connection:
+        return connection.execute('SELECT 1 FROM scans WHERE id = ?', (scan_id,)).fetchone() is not None
+
+
+def get_scan(scan_id):
+    """
+    :return: the catalog entry of the scan and its number of active runs, None if there is none
+    """
+    with _connect() as connection:
+        row = connection.execute('SELECT *, (SELECT count(*) FROM runs WHERE scan_id = scans.id AND finished IS NULL) '
+                                 'AS active_runs FROM scans WHERE id = ?', (scan_id,)).fetchone()
+        return None if row is None else dict(row)
+
+
+def get_scans(limit=None, offset=0, site=None, success=None, since=None, updated_after=None, replayable=False):
+    """
+    Returns catalog entries of scans (newest first) with their runs.
+    :param site: only scans whose site url contains the string
+    :param success: only scans whose first scan succeeded (True) or failed (False)
+    :param since: only scans changed after the seq value
+    :param updated_after: only scans changed after the unix timestamp
+    :param replayable: only scans with a first scan
+    :return: list of scans and the total number of scans matching the filters
+    """
+    conditions = []
+    parameters = []
+    if site is not None:
+        conditions.append("site_url LIKE ? ESCAPE '\\'")
+        parameters.append('%' + site.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if success is not None:
+        conditions.append('success = ?')
+        parameters.append(int(success))
+    if since is not None:
+        conditions.append('seq > ?')
+        parameters.append(since)
+    if updated_after is not None:
+        conditions.append('updated > ?')
+        parameters.append(updated_after)
+    if replayable:
+        conditions.append('EXISTS (SELECT 1 FROM runs WHERE scan_id = scans.id AND name = ?)')
+        parameters.append(FIRST_SCAN_RUN)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+    with _connect() as connection:
+        total = connection.execute(f'SELECT count(*) FROM scans {where}', parameters).fetchone()[0]
+        rows = connection.execute(f'SELECT * FROM scans {where} ORDER BY created DESC, id LIMIT ? OFFSET ?',
+                                  parameters + [-1 if limit is None else limit, offset]).fetchall()
+        scans = [dict(row) for row in rows]
+        runs = dict()
+        if scans:
+            placeholders = ', '.join('?' * len(scans))
+            for run in connection.execute(f'SELECT * FROM runs WHERE scan_id IN ({placeholders}) ORDER BY started, name',
+                                          [scan['id'] for scan in scans]):
+                runs.setdefault(run['scan_id'], []).append(dict(run))
+    for scan in scans:
+        scan['runs'] = runs.get(scan['id'], [])
+    return scans, total
+
+
+def current_seq():
+    with _connect() as connection:
+        return connection.execute('SELECT value FROM counter').fetchone()[0]
+
+
+def _next_seq(connection):
+    connection.execute('UPDATE counter SET value = value + 1')
+    return connection.execute('SELECT value FROM counter').fetchone()[0]
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['rebuild']:
+        print('usage: python catalog.py rebuild')
+        sys.exit(1)
+    # result depends on the catalog module
+    import result
+
+    init()
+    count = result.rebuild_catalog()
+    print(f'Catalog rebuilt, {count} scans indexed.')
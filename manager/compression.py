@@ -0,0 +1,77 @@
+import gzip
+import json
+
+import config
+import errors
+
+try:
+    import zstandard
+except ImportError:
+    # optional, only required for zstd compression
+    zstandard = None
+
+# compression of result.json and the HAR files: none, gzip or zstd
+COMPRESSION = config.storage.get('compression', fallback='none')
+SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+if COMPRESSION not in SUFFIXES:
+    raise errors.ScannerInitError(f'Unknown compression {COMPRESSION} (available: {", ".join(SUFFIXES)}).')
+if COMPRESSION == 'zstd' and zstandard is None:
+    raise errors.ScannerInitError('zstd compression requires the zstandard package (pip install zstandard).')
+
+
+def compressed_path(path, compression=COMPRESSION):
+    """
+    Returns the path of the file stored with the given compression.
+    """
+    return path.with_name(path.name + SUFFIXES[compression])
+
+
+def find(path):
+    """
+    Returns the stored variant of a file (uncompressed or compressed with any codec), None if there is none.
+    """
+    for suffix in SUFFIXES.values():
+        variant = path.with_name(path.name + suffix)
+        if variant.is_file():
+            return variant
+    return None
+
+
+def open_write(path, compression=COMPRESSION):
+    """
+    Opens a file for writing text with the given compression, path is the exact path (see compressed_path).
+    """
+    match compression:
+        case 'gzip':
+            # level 6 is considerably faster than the default 9 at almost the same ratio
+            return gzip.open(path, 'wt', compresslevel=6)
+        case 'zstd':
+            return zstandard.open(path, 'w')
+        case _:
+            return path.open('w')
+
+
+def open_read(path):
+    """
+    Opens a stored file for reading text, path may be the uncompressed name (see find).
+    :raises FileNotFoundError: if no variant of the file exists
+    """
+    stored = path if path.is_file() else find(path)
+    if stored is None:
+        raise FileNotFoundError(f'{path} does not exist.')
+    if stored.name.endswith(SUFFIXES['gzip']):
+        return gzip.open(stored, 'rt')
+    if stored.name.endswith(SUFFIXES['zstd']):
+        if zstandard is None:
+            raise errors.ScannerError(f'Reading {stored} requires the zstandard package (pip install zstandard).')
+        return zstandard.open(stored, 'r')
+    return stored.open()
+
+
+def load_json(path):
+    """
+    Loads a stored JSON file independent of its compression.
+    """
+    with open_read(path) as f:
+        return json.load(f)
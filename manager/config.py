@@ -9,6 +9,20 @@ logger = logs.get_logger('config')
 
 
 def __getattr__(name):
+    cfg = _read()
+    # sections added by later versions may be missing, their options fall back to the defaults of the caller
+    return cfg[name] if cfg.has_section(name) else cfg[cfg.default_section]
+
+
+def sections(prefix):
+    """
+    Returns all sections whose name starts with the prefix, keyed by the remainder of the section name.
+    """
+    cfg = _read()
+    return {name[len(prefix):]: cfg[name] for name in cfg.sections() if name.startswith(prefix)}
+
+
+def _read():
     if not Path(CONFIG_FILE).exists():
         msg = 'CONFIG FILE DOES NOT EXIST. Please create "manager/manager.cfg" from the template.'
         logger.error(msg)
@@ -16,4 +30,4 @@ def __getattr__(name):
 
     cfg = configparser.ConfigParser()
     cfg.read(CONFIG_FILE)
-    return cfg[name]
+    return cfg
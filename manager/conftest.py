@@ -0,0 +1,10 @@
+from pathlib import Path
+
+import config
+
+# analysis script of the study (see study/), not a test
+collect_ignore = ['test_main.py']
+
+# the tests only need the defaults of the template unless a manager.cfg exists
+if not Path(config.CONFIG_FILE).exists():
+    config.CONFIG_FILE = str(Path(__file__).parent / 'manager.cfg.template')
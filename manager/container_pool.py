@@ -0,0 +1,109 @@
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+from podman.errors import PodmanError
+
+import logs
+import podman_container
+
+# seconds between two maintenance rounds of the pool
+POOL_CHECK_INTERVAL = 10
+
+logger = logs.get_logger('container_pool')
+
+
+class PooledContainer:
+    def __init__(self, container):
+        self.container = container
+        self.started = time.monotonic()
+
+    def idle_time(self):
+        return time.monotonic() - self.started
+
+
+class ContainerPool:
+    """
+    Keeps a number of chrome_scan containers running, so that a scan does not have to wait for a cold start.
+
+    Containers are leased to scans with lease() and replaced in the background.
+    A pool size of 0 disables the pool, lease() then starts a new container for every scan.
+    """
+
+    def __init__(self, size, max_idle_age):
+        self.size = size
+        self.max_idle_age = max_idle_age
+        self._idle = deque()
+        self._lock = Lock()
+        self._refill = Event()
+        self._stopped = Event()
+        self._thread = Thread(target=self._maintain, name='container_pool', daemon=True)
+
+    def start(self):
+        if self.size > 0:
+            logger.info(f'Starting container pool (size={self.size}, max idle age={self.max_idle_age}s).')
+            self._thread.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._refill.set()
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for pooled in idle:
+            self._discard(pooled)
+
+    def lease(self):
+        """
+        Returns a running container, preferably one that was started in advance.
+        :raises PodmanError: if no container could be started
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                pooled = self._idle.popleft()
+            self._refill.set()
+            if pooled.idle_time() < self.max_idle_age and podman_container.is_running(pooled.container.id):
+                podman_container.mark_leased(pooled.container.id)
+                logger.info(f'Leased pre-started container (container id={pooled.container.id}).')
+                return pooled.container
+            self._discard(pooled)
+        if self.size > 0:
+            logger.warning('Container pool exhausted, starting container on demand.')
+        return podman_container.run_container()
+
+    def _maintain(self):
+        while not self._stopped.is_set():
+            try:
+                self._retire_idle()
+                self._fill()
+            except Exception as e:
+                # keep the pool alive, podman might just be temporarily unavailable
+                logger.error(f'Container pool maintenance failed: {e}', exc_info=e)
+            self._refill.wait(timeout=POOL_CHECK_INTERVAL)
+            self._refill.clear()
+
+    def _retire_idle(self):
+        with self._lock:
+            retired = [p for p in self._idle if p.idle_time() >= self.max_idle_age]
+            for pooled in retired:
+                self._idle.remove(pooled)
+        for pooled in retired:
+            logger.info(f'Retiring idle container (container id={pooled.container.id}).')
+            self._discard(pooled)
+
+    def _fill(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    return
+            container = podman_container.run_container()
+            with self._lock:
+                self._idle.append(PooledContainer(container))
+
+    def _discard(self, pooled):
+        try:
+            podman_container.stop_container(pooled.container.id)
+        except PodmanError as e:
+            logger.warning(f'Could not stop pooled container {pooled.container.id}: {e}')
@@ -4,3 +4,10 @@ class ScannerInitError(ValueError):
 
 class ScannerError(Exception):
     pass
+
+
+class AdmissionError(ScannerError):
+    def __init__(self, msg, retry_after):
+        super().__init__(msg)
+        # seconds after which the client should try again
+        self.retry_after = retry_after
@@ -2,4 +2,5 @@ from .cookies import CookiesExtractor
 from .profile import ProfileExtractor
 from .requests import RequestsExtractor
 from .responses import ResponsesExtractor
-from .tp_cookies import TPCookiesExtractor
+
+EXTRACTOR_CLASSES = [CookiesExtractor, RequestsExtractor, ResponsesExtractor, ProfileExtractor]
@@ -1,4 +1,11 @@
 class Extractor:
+    # name used to select the extractor in the scanner options
+    name = None
+    # names of extractors which have to complete before this extractor starts
+    depends_on = ()
+    # max seconds extract_information may take
+    timeout = 60
+
     def __init__(self, browser, page, options):
         self.browser = browser
         self.page = page
@@ -1,15 +1,20 @@
 import logs
+import utils
 from extractors.base import Extractor
 
 logger = logs.get_logger('cookie_extractor')
 
 
 class CookiesExtractor(Extractor):
+    name = 'cookies'
+
     async def extract_information(self):
         logger.info('extracting cookie info')
         cookies = await self.browser.get_cookies()
         list(map(lambda x: calc_lifetime(x, self.page.scan_time), cookies))
-        return {'cookies': cookies}
+        # first party cookies are split off locally instead of fetching the cookies of the page url separately
+        fp_cookies = [c for c in cookies if utils.cookie_matches_url(c, self.page.url)]
+        return {'cookies': cookies, 'fp_cookies': fp_cookies}
 
 
 def calc_lifetime(cookie, scan_time):
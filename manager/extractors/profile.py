@@ -1,4 +1,9 @@
+import asyncio
+import itertools
+from urllib.parse import urlparse
+
 import logs
+import profile_store
 from extractors.base import Extractor
 
 from errors import ScannerError
@@ -6,9 +11,37 @@ logger = logs.get_logger('profile_extractor')
 
 
 class ProfileExtractor(Extractor):
+    name = 'profile'
+    # large profiles take a while to be transferred and stored
+    timeout = 120
+
     async def extract_information(self):
         logger.info('extracting profile info')
         profile = await self.browser.cdp_send_message("Profiler.stop")
         if profile is None or profile['profile'] is None:
             raise ScannerError('profile is none! Was not started properly.')
-        return {'profile': profile['profile']}
+        profile = profile['profile']
+        if self.options.profile_third_party_only:
+            site = _site(urlparse(self.page.url).hostname)
+            profile = profile_store.filter_profile(profile, lambda call_frame: _is_third_party(call_frame, site))
+        path = self._profile_path()
+        summary = await asyncio.to_thread(profile_store.store_profile, profile, path)
+        # path relative to the scan folder (see profile_store.load_nodes / load_profile)
+        return {'profile': {'file': f'{path.parent.name}/{path.name}', 'summary': summary}}
+
+    def _profile_path(self):
+        for i in itertools.count():
+            path = self.browser.files_path / f'profile_{i}.npz'
+            if not path.exists():
+                return path
+
+
+def _is_third_party(call_frame, site):
+    hostname = urlparse(call_frame['url']).hostname
+    # frames without script url (e.g. (program), (garbage collector)) are kept
+    return not hostname or _site(hostname) != site
+
+
+def _site(hostname):
+    # approximation of the registrable domain (does not know public suffixes like co.uk)
+    return '.'.join((hostname or '').split('.')[-2:])
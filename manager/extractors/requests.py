@@ -1,13 +1,12 @@
 import logs
-import result
 from extractors.base import Extractor
 
 logger = logs.get_logger('requests_extractor')
 
 
 class RequestsExtractor(Extractor):
+    name = 'requests'
+
     async def extract_information(self):
-        requests = []
-        for r in self.page.request_log:
-            requests.append(await result.parse_request(r))
-        return {'requests': requests}
+        return {'requests': await self.page.get_requests(),
+                'failed_requests': await self.page.get_failed_requests()}
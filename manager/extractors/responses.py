@@ -1,14 +1,11 @@
 import logs
-import result
 from extractors.base import Extractor
 
 logger = logs.get_logger('response_extractor')
 
 
 class ResponsesExtractor(Extractor):
-    async def extract_information(self):
-        responses = []
-        for r in self.page.response_log:
-            responses.append(await result.parse_response(r))
+    name = 'responses'
 
-        return {'responses': responses}
+    async def extract_information(self):
+        return {'responses': await self.page.get_responses()}
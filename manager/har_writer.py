@@ -0,0 +1,289 @@
+import asyncio
+import gzip
+import json
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlparse
+
+import compression
+import logs
+
+HAR_PREFIX = 'network_'
+# suffix of the entries written so far, one JSON line per entry
+# parts of compressed HAR files are written with gzip, its sync flushes keep the stream readable after a crash
+PART_SUFFIX = '.har.jsonl'
+HAR_CREATOR = {"name": "interactive_privacyscanner", "version": "1.0"}
+
+logger = logs.get_logger('har_writer')
+
+
+class HarWriter:
+    """
+    Writes the network traffic of a browser as HAR files, built from CDP Network events.
+
+    Every entry is appended to a part file as soon as its request completed (or failed),
+    so the entries survive a crash of the scanner. The entries are written in batches by a worker thread,
+    the event handlers never block the event loop of the scanner.
+    rotate() closes the part, which is then converted to a HAR file
+    (finalize_part), the traffic of every interaction is therefore stored in its own file network_<n>.har
+    (compressed with the configured codec, see compression.COMPRESSION).
+    Response contents are omitted.
+    """
+
+    def __init__(self, browser, files_path, codec=compression.COMPRESSION):
+        self.browser = browser
+        self.files_path = files_path
+        self.codec = codec
+        self._index = 0
+        self._part = None
+        # serialized entries not written yet, see _write_pending
+        self._pending = []
+        self._write_task = None
+        # request id -> entry of requests in flight
+        self._entries = dict()
+        # request id -> raw request headers received before the request itself
+        self._extra_headers = dict()
+
+    def register(self):
+        # Network.enable is sent in InteractiveScanner._register_callbacks
+        self.browser.register_event('Network.requestWillBeSent', self._request_will_be_sent)
+        self.browser.register_event('Network.requestWillBeSentExtraInfo', self._request_extra_info)
+        self.browser.register_event('Network.responseReceived', self._response_received)
+        self.browser.register_event('Network.responseReceivedExtraInfo', self._response_extra_info)
+        self.browser.register_event('Network.loadingFinished', self._loading_finished)
+        self.browser.register_event('Network.loadingFailed', self._loading_failed)
+
+    async def rotate(self):
+        """
+        Writes the pending entries and closes the current part, later entries are written to a new part.
+        :return: path of the closed part (see finalize_part), None if no entry was written since the last rotation
+        """
+        while self._write_task is not None and not self._write_task.done():
+            await self._write_task
+        if self._part is None:
+            return None
+        await asyncio.to_thread(self._part.close)
+        self._part = None
+        part_path = self._part_path(self._index)
+        self._index += 1
+        return part_path
+
+    async def close(self):
+        """
+        Writes the entries of requests still in flight and closes the last part (see rotate).
+        """
+        for request_id in list(self._entries):
+            self._write(request_id)
+        return await self.rotate()
+
+    def _request_will_be_sent(self, params):
+        request_id = params['requestId']
+        if 'redirectResponse' in params and request_id in self._entries:
+            # redirects reuse the request id, the event contains the response of the previous request
+            self._set_response(self._entries[request_id], params['redirectResponse'])
+            self._set_timings(self._entries[request_id], params['timestamp'])
+            self._write(request_id)
+
+        request = params['request']
+        url = request['url'] + request.get('urlFragment', '')
+        entry = {"startedDateTime": _iso_time(params['wallTime']),
+                 "time": 0,
+                 "request": {"method": request['method'],
+                             "url": url,
+                             "httpVersion": "",
+                             "cookies": [],
+                             "headers": _headers(self._extra_headers.pop(request_id, None) or request['headers']),
+                             "queryString": [{"name": n, "value": v}
+                                             for n, v in parse_qsl(urlparse(url).query, keep_blank_values=True)],
+                             "headersSize": -1,
+                             "bodySize": len(request.get('postData', '').encode())},
+                 "response": _empty_response(),
+                 "cache": {},
+                 "timings": {"send": 0, "wait": 0, "receive": 0},
+                 "_resourceType": params.get('type', '').lower(),
+                 # monotonic timestamps in seconds, removed before the entry is written
+                 "_start": params['timestamp'],
+                 "_timing": None}
+        if 'postData' in request:
+            entry['request']['postData'] = {"mimeType": _header(request['headers'], 'content-type'),
+                                            "text": request['postData']}
+        self._entries[request_id] = entry
+
+    def _request_extra_info(self, params):
+        headers = _headers(params['headers'])
+        if params['requestId'] in self._entries:
+            self._entries[params['requestId']]['request']['headers'] = headers
+        else:
+            self._extra_headers[params['requestId']] = params['headers']
+
+    def _response_received(self, params):
+        entry = self._entries.get(params['requestId'])
+        if entry is not None:
+            self._set_response(entry, params['response'])
+
+    def _response_extra_info(self, params):
+        entry = self._entries.get(params['requestId'])
+        if entry is not None:
+            entry['response']['headers'] = _headers(params['headers'])
+
+    def _loading_finished(self, params):
+        entry = self._entries.get(params['requestId'])
+        if entry is not None:
+            entry['response']['_transferSize'] = params.get('encodedDataLength', -1)
+            self._set_timings(entry, params['timestamp'])
+            self._write(params['requestId'])
+
+    def _loading_failed(self, params):
+        entry = self._entries.get(params['requestId'])
+        if entry is not None:
+            entry['response']['_errorText'] = params.get('errorText', '')
+            self._set_timings(entry, params['timestamp'])
+            self._write(params['requestId'])
+
+    def _set_response(self, entry, response):
+        headers = response['headers']
+        entry['request']['httpVersion'] = entry['response']['httpVersion'] = response.get('protocol', '')
+        entry['response'].update({"status": response['status'],
+                                  "statusText": response.get('statusText', ''),
+                                  "headers": _headers(headers),
+                                  "content": {"size": -1, "mimeType": response.get('mimeType', '')},
+                                  "redirectURL": _header(headers, 'location')})
+        if response.get('remoteIPAddress'):
+            entry['serverIPAddress'] = response['remoteIPAddress']
+        entry['_timing'] = response.get('timing')
+
+    def _set_timings(self, entry, end_timestamp):
+        # see https://chromedevtools.github.io/devtools-protocol/tot/Network/#type-ResourceTiming
+        total = max(0.0, (end_timestamp - entry['_start']) * 1000)
+        timing = entry['_timing']
+        if timing is None:
+            # e.g. served from the memory cache or failed before it was sent
+            entry['timings'] = {"send": 0, "wait": 0, "receive": round(total, 3)}
+            entry['time'] = round(total, 3)
+            return
+        offset = (timing['requestTime'] - entry['_start']) * 1000
+        blocked = offset + next((t for t in (timing['dnsStart'], timing['connectStart'], timing['sendStart'])
+                                 if t >= 0), 0)
+        timings = {"blocked": blocked,
+                   "dns": _duration(timing['dnsStart'], timing['dnsEnd']),
+                   "connect": _duration(timing['connectStart'], timing['connectEnd']),
+                   "ssl": _duration(timing['sslStart'], timing['sslEnd']),
+                   "send": max(0.0, timing['sendEnd'] - timing['sendStart']),
+                   "wait": max(0.0, timing['receiveHeadersEnd'] - timing['sendEnd']),
+                   "receive": max(0.0, total - offset - timing['receiveHeadersEnd'])}
+        entry['timings'] = {name: round(value, 3) for name, value in timings.items()}
+        # ssl is part of connect
+        entry['time'] = round(sum(max(0, v) for name, v in timings.items() if name != 'ssl'), 3)
+
+    def _write(self, request_id):
+        entry = self._entries.pop(request_id)
+        del entry['_start'], entry['_timing']
+        self._pending.append(json.dumps(entry) + '\n')
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # entries arriving while a batch is written form the next batch
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write_lines, batch, self._part_path(self._index))
+            except (OSError, zlib.error) as e:
+                logger.error(f'Could not write {len(batch)} HAR entries: {e}')
+
+    def _write_lines(self, lines, part_path):
+        if self._part is None:
+            self._part = _open_part(part_path)
+        self._part.writelines(lines)
+        # written entries survive a crash of the scanner (gzip: sync flush, the stream stays readable)
+        self._part.flush()
+
+    def _part_path(self, index):
+        suffix = PART_SUFFIX + ('' if self.codec == 'none' else '.gz')
+        return self.files_path / f'{HAR_PREFIX}{index}{suffix}'
+
+
+def finalize_part(part_path, codec=compression.COMPRESSION):
+    """
+    Converts a part into a HAR file compressed with the codec and removes the part.
+    Entries are streamed, a truncated last entry (e.g. after a crash) is skipped.
+    :return: path of the HAR file
+    """
+    compressed = part_path.name.endswith('.gz')
+    har_path = compression.compressed_path(part_path.with_name(part_path.name.split(PART_SUFFIX)[0] + '.har'), codec)
+    tmp_path = har_path.with_name(har_path.name + '.tmp')
+    with compression.open_write(tmp_path, codec) as har:
+        har.write('{"log": {"version": "1.2", "creator": ' + json.dumps(HAR_CREATOR) + ', "pages": [], "entries": [\n')
+        first = True
+        for line in _read_lines(part_path, compressed):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning(f'Skipping truncated HAR entry in {part_path}.')
+                continue
+            har.write(('' if first else ',\n') + json.dumps(entry))
+            first = False
+        har.write('\n]}}\n')
+    tmp_path.replace(har_path)
+    part_path.unlink()
+    return har_path
+
+
+def recover_parts(results_path):
+    """
+    Converts the parts left behind by terminated scanners into HAR files.
+    Must not run while scans are active, their current parts would be converted as well.
+    """
+    for part_path in results_path.glob(f'*/*/files/{HAR_PREFIX}*{PART_SUFFIX}*'):
+        try:
+            finalize_part(part_path)
+            logger.info(f'Recovered HAR part {part_path}.')
+        except (OSError, EOFError, zlib.error) as e:
+            logger.error(f'Could not recover HAR part {part_path}: {e}')
+
+
+def _open_part(path):
+    if path.name.endswith('.gz'):
+        return gzip.open(path, 'at')
+    return path.open('a')
+
+
+def _read_lines(path, compressed):
+    if not compressed:
+        with path.open() as f:
+            yield from f
+        return
+    # the gzip stream of a crashed scanner lacks its trailer, decompress what is there
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    rest = b''
+    with path.open('rb') as f:
+        while chunk := f.read(64 * 1024):
+            lines = (rest + decompressor.decompress(chunk)).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line.decode()
+    if rest:
+        yield rest.decode(errors='replace')
+
+
+def _empty_response():
+    # response of requests that failed before a response was received
+    return {"status": 0, "statusText": "", "httpVersion": "", "cookies": [], "headers": [],
+            "content": {"size": -1, "mimeType": ""}, "redirectURL": "", "headersSize": -1, "bodySize": -1}
+
+
+def _headers(headers):
+    # header values of the same name are joined by newlines in CDP
+    return [{"name": name, "value": value} for name, values in headers.items() for value in values.split('\n')]
+
+
+def _header(headers, name):
+    return next((value for key, value in headers.items() if key.lower() == name), '')
+
+
+def _duration(start, end):
+    return end - start if start >= 0 else -1
+
+
+def _iso_time(wall_time):
+    return datetime.fromtimestamp(wall_time, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
@@ -1,38 +1,52 @@
 import asyncio
+import itertools
 import json
 import time
-from threading import Thread
+from threading import Event
 from urllib.parse import urlparse
 
-import janus
-
+import config
 import logs
-import podman_container
 import result
+import scanner_runtime
 from browser import Browser
+from capture_buffer import CaptureBuffer
+from har_writer import HarWriter, finalize_part
 from errors import ScannerInitError, ScannerError
-from extractors import CookiesExtractor, RequestsExtractor, ResponsesExtractor, ProfileExtractor, TPCookiesExtractor
+from network_recorder import NetworkRecorder
 from result import Result, ResultKey
 from scanner_messages import ScannerMessage, MessageType
+from scanner_options import ScannerOptions
 
-EXTRACTOR_CLASSES = [CookiesExtractor, RequestsExtractor, ResponsesExtractor, ProfileExtractor, TPCookiesExtractor]
 SCANNER_KEY = 'SCANNER_INTERACTION'
+# max number of requests and responses of a page serialized concurrently
+CAPTURE_CONCURRENCY = 16
+# source of request and response records: playwright (request / response objects) or cdp (Network events)
+NETWORK_RECORDER = config.scanner.get('network_recorder', fallback='playwright')
+# bytes of serialized requests (responses, failed requests) of a page kept in memory, older records are spilled to disk
+CAPTURE_MEMORY_LIMIT = config.scanner.getint('capture_memory_limit', fallback=64) * 1024 ** 2
 
 logger = logs.get_logger('scanner')
 
+_scanner_ids = itertools.count(1)
+_page_ids = itertools.count(1)
+
 
-class InteractiveScanner(Thread):
-    def __init__(self, url, debugging_port, container_id, options, socket, reference_scan_id=None):
-        super().__init__()
-        # Mark this thread as daemon
-        self.daemon = True
+class InteractiveScanner:
+    """
+    Runs a scan as a task of the shared scanner runtime (see scanner_runtime), instructed through put_msg.
+    """
 
+    def __init__(self, url, container, options, socket, reference_scan_id=None):
+        """
+        :param options: ScannerOptions of the scan, None uses the defaults
+        """
+        self.name = f'Scanner-{next(_scanner_ids)}'
         self.logger = logs.get_logger(f'cdp_controller_{self.name}')
 
-        # Init Message Queue
-        self.event_loop = asyncio.new_event_loop()
-        init_queue_task = self.event_loop.create_task(self._init_queue())
-        self.event_loop.run_until_complete(init_queue_task)
+        # Init Message Queue (bound to the event loop on first use, messages are passed in through put_msg)
+        self._runtime = scanner_runtime.get_runtime()
+        self._queue = asyncio.Queue()
 
         # Set socket
         self.client_socket = socket
@@ -41,69 +55,125 @@ class InteractiveScanner(Thread):
         self.url = url
         self.start_url_netloc = urlparse(url).netloc
         self.initial_scan = reference_scan_id is None
+        self.options = options or ScannerOptions()
         self.result = self._init_result() if self.initial_scan else self._load_result(reference_scan_id)
-        self.debugging_port = debugging_port
-        self.container_id = container_id
-        self.options = options
+        self.container = container
+        self.container_id = container.id
+        # set once the scanner terminated, error holds the reason of an aborted scan
+        self.completed = Event()
+        # time.monotonic() of the termination
+        self.completed_at = None
+        self.error = None
+        self._future = None
+        self._stop_reason = None
+        self._completion_callbacks = []
         self._extractors = []
-        self._page = Page(self.url)
+        self._har_writer = None
+        self._network_recorder = None
+        self._page = Page(self.url, self.result.get_files_path())
 
     def _init_result(self):
         site_parsed = urlparse(self.url)
         if site_parsed.scheme not in ("http", "https"):
             raise ScannerInitError("Invalid site url: {}".format(self.url))
-        result_json = {ResultKey.SITE_URL: self.url, ResultKey.INTERACTION: []}
+        result_json = {ResultKey.SITE_URL: self.url, ResultKey.OPTIONS: self.options.to_json(),
+                       ResultKey.INTERACTION: []}
         result_id = result.get_result_id(site_parsed.netloc)
         return Result(result_json, result_id, self.initial_scan)
 
     def _load_result(self, reference_scan_id):
-        result_json = {ResultKey.SITE_URL: self.url, ResultKey.INTERACTION: []}
+        result_json = {ResultKey.SITE_URL: self.url, ResultKey.OPTIONS: self.options.to_json(),
+                       ResultKey.INTERACTION: []}
         return Result(result_json, reference_scan_id, self.initial_scan)
 
-    async def _init_queue(self):
-        self._queue = janus.Queue()
+    def start(self):
+        self._future = self._runtime.submit(self._run())
 
-    def run(self):
-        self.event_loop.run_until_complete(self._start_scanner())
-        self.event_loop.close()
+    def stop(self, reason):
+        """
+        Cancels the scan (thread-safe), e.g. if it does not complete in time.
+        The container is released and the result is stored with the reason as error.
+        """
+        self._stop_reason = reason
+        if self._future is not None:
+            self._future.cancel()
+
+    async def _run(self):
+        try:
+            await self._start_scanner()
+        except asyncio.CancelledError:
+            self.error = self._stop_reason or 'Scanner was stopped.'
+            self.logger.error(self.error)
+            self.result[ResultKey.ERROR] = self.error
+            try:
+                await asyncio.to_thread(self.result.store_result)
+            except ScannerInitError as e:
+                self.logger.error(f'Could not store result of stopped scanner: {e}')
+        except Exception as e:
+            self.error = str(e)
+            self.logger.error(self.error, exc_info=e)
+        finally:
+            self.completed_at = time.monotonic()
+            self.completed.set()
+            for callback in self._completion_callbacks:
+                callback()
+
+    def add_completion_callback(self, callback):
+        """
+        Registers a function which is called once the scanner terminated.
+        """
+        self._completion_callbacks.append(callback)
 
     def put_msg(self, msg):
         logger.debug(f'Scanner message {msg} added to Queue.')
         if not isinstance(msg, ScannerMessage):
             raise ScannerError('Element is not a Scanner Message.')
-        if self._queue is None:
-            raise ScannerInitError('Queue not correctly initialized.')
-        self._queue.sync_q.put(msg)
+        if self.completed.is_set():
+            logger.warning(f'Scanner already terminated, ignoring message {msg}.')
+            return
+        self._runtime.call_soon(self._queue.put_nowait, msg)
 
     async def _start_scanner(self):
         files_path = self.result.get_files_path()
-        async with Browser(self.debugging_port, files_path) as browser:
-            self.browser = browser
-            while True:
-                self.logger.info("Waiting for scanner message.")
-                message = await self._queue.async_q.get()
-                try:
-                    rec_poison_pill = await self._process_message(message)
-                    if rec_poison_pill:
-                        self.logger.info('Scan complete, terminating thread.')
-                        break
-                except ScannerError as e:
-                    error_msg = str(e)
-                    self.logger.error(error_msg)
-                    self.result[ResultKey.ERROR] = error_msg
-                    self.result.store_result()
+        try:
+            async with Browser(self.container.address, self.container.devtools_port, files_path,
+                               ready=self.container.ready_time is not None) as browser:
+                self.browser = browser
+                await self._process_messages()
+        finally:
+            try:
+                await self._close_har()
+            finally:
+                # Stop container (or free the browser context) after disconnecting from browser
+                await asyncio.to_thread(self.container.release)
+        await self.send_socket_msg({"ScanComplete": ""})
+
+    async def _process_messages(self):
+        while True:
+            self.logger.info("Waiting for scanner message.")
+            message = await self._queue.get()
+            try:
+                rec_poison_pill = await self._process_message(message)
+                if rec_poison_pill:
+                    self.logger.info('Scan complete, terminating scanner.')
                     break
-                except Exception as e:
-                    # TODO inform user about abort (see #29)
-                    error_msg = str(e)
-                    # include stack trace
-                    self.logger.error(error_msg, exc_info=e)
-                    self.result[ResultKey.ERROR] = error_msg
-                    self.result.store_result()
-                    break
-        # Stop container after disconnecting from browser
-        podman_container.stop_container(self.container_id)
-        self.send_socket_msg({"ScanComplete": ""})
+            except ScannerError as e:
+                error_msg = str(e)
+                self.logger.error(error_msg)
+                await self._abort(error_msg)
+                break
+            except Exception as e:
+                # TODO inform user about abort (see #29)
+                error_msg = str(e)
+                # include stack trace
+                self.logger.error(error_msg, exc_info=e)
+                await self._abort(error_msg)
+                break
+
+    async def _abort(self, error_msg):
+        self.error = error_msg
+        self.result[ResultKey.ERROR] = error_msg
+        await asyncio.to_thread(self.result.store_result)
 
     async def _process_message(self, message):
         self.logger.info(f'processing message {message}')
@@ -128,14 +198,15 @@ class InteractiveScanner(Thread):
 
     # Socket Communication
 
-    def send_socket_msg(self, msg):
+    async def send_socket_msg(self, msg):
         msg_json = json.dumps(msg)
         if self.client_socket is None:
             logger.error('Client socket not set up, ignoring message:' + msg_json)
             return
         else:
             logger.info('sending message' + msg_json)
-            self.client_socket.send(msg_json)
+            # the websocket send blocks until the message is written, a slow client must not stall the event loop
+            await asyncio.to_thread(self.client_socket.send, msg_json)
 
     # Scanner Functions
 
@@ -143,13 +214,36 @@ class InteractiveScanner(Thread):
         """
         Create new target and navigate to page
         """
-        await self.browser.start_profiler()
+        await self._start_profiler()
         await self._register_callbacks()
         await self.browser.ignore_inputs(True)
         await self._navigate_to_page()
         await self._record_information(ResultKey.INITIAL_SCAN)
         await self.browser.ignore_inputs(False)
-        self.send_socket_msg({"ScanComplete": ""})
+        await self.send_socket_msg({"ScanComplete": ""})
+
+    async def _rotate_har(self):
+        """
+        Converts the network traffic since the last interaction into a HAR file.
+        :return: path of the HAR file, None if there was no traffic
+        """
+        if self._har_writer is None:
+            return None
+        part_path = await self._har_writer.rotate()
+        if part_path is None:
+            return None
+        return await asyncio.to_thread(finalize_part, part_path)
+
+    async def _close_har(self):
+        if self._har_writer is None:
+            return
+        part_path = await self._har_writer.close()
+        if part_path is not None:
+            await asyncio.to_thread(finalize_part, part_path)
+
+    async def _start_profiler(self):
+        if self.options.extractor_enabled('profile'):
+            await self.browser.start_profiler(self.options.sampling_interval)
 
     async def _navigate_to_page(self):
         self.logger.info("Navigating to Start URL.")
@@ -167,20 +261,32 @@ class InteractiveScanner(Thread):
         intermediate_result = {ResultKey.URL: url, ResultKey.EVENT: reason, ResultKey.TIMESTAMP: self._page.scan_time,
                                ResultKey.SCREENSHOTS: self._page.screenshots,
                                ResultKey.USER_INTERACTION: self._page.user_interaction}
-        self._extractors.clear()
-        for extractor_class in EXTRACTOR_CLASSES:
-            self._extractors.append(extractor_class(self.browser, self._page, self.options))
-
-        for extractor in self._extractors:
-            extractor_info = await extractor.extract_information()
-            # append result
-            intermediate_result = intermediate_result | extractor_info.copy()
+        if self._network_recorder is not None:
+            # records of requests still in flight are part of this interaction
+            self._network_recorder.flush(self._page)
+        self._extractors = [extractor_class(self.browser, self._page, self.options)
+                            for extractor_class in self.options.extractor_classes()]
+        extracted, extractor_times, extractor_errors = await run_extractors(self._extractors)
+        intermediate_result[ResultKey.EXTRACTOR_TIMES] = extractor_times
+        if extractor_errors:
+            intermediate_result[ResultKey.EXTRACTOR_ERRORS] = extractor_errors
+        for extractor_info in extracted:
+            intermediate_result.update(extractor_info)
+        har_path = await self._rotate_har()
+        if har_path is not None:
+            # path relative to the scan folder
+            intermediate_result[ResultKey.HAR] = f'{har_path.parent.name}/{har_path.name}'
 
         if reason != ResultKey.END_SCAN:
             # Start the profiler again, if it was not the last scan.
-            await self.browser.start_profiler()
-        self._page = Page(self.url)
-        self.result[ResultKey.INTERACTION].append(intermediate_result.copy())
+            await self._start_profiler()
+        page = self._page
+        self._page = Page(self.url, self.result.get_files_path())
+        try:
+            # the spilled records are streamed from disk into the journal
+            await asyncio.to_thread(self.result.add_interaction, intermediate_result)
+        finally:
+            await page.discard_spilled()
 
     async def _perform_user_interaction(self, user_interaction):
         if self.initial_scan:
@@ -192,27 +298,27 @@ class InteractiveScanner(Thread):
         await self.browser.ignore_inputs(True)
         await self._record_information(ResultKey.MANUAL_INTERACTION)
         await self.browser.ignore_inputs(False)
-        self.send_socket_msg({"ScanComplete": ""})
+        await self.send_socket_msg({"ScanComplete": ""})
 
     async def _clear_cookies(self):
         await self.browser.ignore_inputs(True)
         await self._record_information(ResultKey.DELETE_COOKIES)
         await self.browser.clear_cookies()
         await self.browser.ignore_inputs(False)
-        self.send_socket_msg({"ScanComplete": ""})
-        self.send_socket_msg({"Log": "Cookies deleted."})
+        await self.send_socket_msg({"ScanComplete": ""})
+        await self.send_socket_msg({"Log": "Cookies deleted."})
 
     async def _take_screenshot(self):
         path = self.result.get_files_path() / f'screenshot_{self.result.num_screenshots}.jpeg'
         self._page.add_screenshot_path(path)
         await self.browser.take_screenshot(path)
         self.result.num_screenshots += 1
-        self.send_socket_msg({"Log": "Screenshot saved."})
+        await self.send_socket_msg({"Log": "Screenshot saved."})
 
     async def _stop_scan(self, note):
         await self.browser.ignore_inputs(True)
         await self._record_information(ResultKey.END_SCAN)
-        self.result.store_result(note=note)
+        await asyncio.to_thread(self.result.store_result, note=note)
         self.result = None
 
     # Callback Functions
@@ -223,6 +329,11 @@ class InteractiveScanner(Thread):
     async def _response_received(self, response):
         self._page.add_response(response)
 
+    async def _request_failed(self, request):
+        self._page.add_failed_request({"url": request.url,
+                                       "method": request.method,
+                                       "error": request.failure})
+
     async def _frame_navigated(self, frame):
         logger.debug(frame)
         frame = frame['frame']
@@ -230,7 +341,7 @@ class InteractiveScanner(Thread):
         if frame['url'] != 'about:blank':
             url = urlparse(frame['url'])
             url_str = f"{url.scheme}://{url.netloc}/..."
-            self.send_socket_msg({"URLChanged": url_str})
+            await self.send_socket_msg({"URLChanged": url_str})
 
     async def _console_msg_received(self, console_message):
         msg_text = console_message.text
@@ -254,31 +365,152 @@ class InteractiveScanner(Thread):
         await self.browser.cdp_send_message('Debugger.enable')
         await self.browser.cdp_send_message('Runtime.enable')
 
-        # Enable callbacks
-        self.browser.register_page_event("request", self._request_sent)
-        self.browser.register_page_event("response", self._response_received)
+        self._har_writer = HarWriter(self.browser, self.result.get_files_path())
+        self._har_writer.register()
+
+        # Enable callbacks, requests and responses are only recorded if they are extracted
+        record_requests = self.options.extractor_enabled('requests')
+        record_responses = self.options.extractor_enabled('responses')
+        if NETWORK_RECORDER == 'cdp':
+            if record_requests or record_responses:
+                self._network_recorder = NetworkRecorder(self.browser, lambda: self._page)
+                self._network_recorder.register()
+        else:
+            if record_requests:
+                self.browser.register_page_event("request", self._request_sent)
+                self.browser.register_page_event("requestfailed", self._request_failed)
+            if record_responses:
+                self.browser.register_page_event("response", self._response_received)
         # self.browser.register_page_event("framenavigated", self._frame_navigated)
         self.browser.register_page_event("console", self._console_msg_received)
 
 
+async def run_extractors(extractors):
+    """
+    Runs the extractors concurrently, an extractor starts as soon as the extractors it depends on completed.
+    An extractor that times out is logged and skipped, the information of the other extractors is kept.
+    Extractors depending on a skipped extractor are skipped as well.
+    :return: the extracted information of every completed extractor (in the order of extractors),
+             the wall time of every extractor that ran in seconds and the errors of skipped extractors
+             (by extractor name)
+    """
+    tasks = dict()
+    times = dict()
+    errors = dict()
+
+    async def run(extractor):
+        dependencies = [name for name in extractor.depends_on if name in tasks]
+        if dependencies:
+            await asyncio.gather(*(tasks[name] for name in dependencies))
+        failed = [name for name in dependencies if name in errors]
+        if failed:
+            errors[extractor.name] = f'Extractor {extractor.name} skipped, {", ".join(failed)} did not complete.'
+            logger.error(errors[extractor.name])
+            return None
+        start = time.monotonic()
+        try:
+            return await asyncio.wait_for(extractor.extract_information(), extractor.timeout)
+        except asyncio.TimeoutError:
+            errors[extractor.name] = f'Extractor {extractor.name} timed out after {extractor.timeout} seconds.'
+            logger.error(errors[extractor.name])
+            return None
+        finally:
+            times[extractor.name] = round(time.monotonic() - start, 3)
+
+    # all tasks are created before the first one runs, dependencies can therefore be looked up by name
+    for extractor in extractors:
+        tasks[extractor.name] = asyncio.create_task(run(extractor))
+    try:
+        extracted = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return [e for e in extracted if e is not None], times, errors
+
+
 class Page:
-    def __init__(self, url):
+    """
+    Information about the page collected since the last recorded interaction.
+
+    Requests and responses are serialized in the background as soon as they arrive,
+    the extractors only collect the finished records (lazily, they are read while the interaction is journaled).
+    Records beyond CAPTURE_MEMORY_LIMIT are spilled to the files directory of the scan (see CaptureBuffer).
+    """
+
+    def __init__(self, url, files_path):
         self.url = url
         self.scan_time = int(time.time())
-        self.request_log = []
-        self.failed_request_log = []
-        self.response_log = []
+        page_id = next(_page_ids)
+        self.request_log = CaptureBuffer(files_path / f'requests_{page_id}.jsonl', CAPTURE_MEMORY_LIMIT)
+        self.failed_request_log = CaptureBuffer(files_path / f'failed_requests_{page_id}.jsonl', CAPTURE_MEMORY_LIMIT)
+        self.response_log = CaptureBuffer(files_path / f'responses_{page_id}.jsonl', CAPTURE_MEMORY_LIMIT)
         self.screenshots = []
         self.user_interaction = []
+        self._pending = set()
+        self._capture_semaphore = asyncio.Semaphore(CAPTURE_CONCURRENCY)
 
     def add_request(self, request):
-        self.request_log.append(request)
+        self._capture(result.parse_request(request), self.request_log)
+
+    def reserve_request_record(self):
+        """
+        Reserves the slot of a request record which is set once it is complete (see CaptureBuffer).
+        """
+        return self.request_log.reserve()
+
+    def set_request_record(self, index, record):
+        self.request_log.set(index, record)
 
-    def add_failed_request(self, request):
-        self.failed_request_log.append(request)
+    def add_failed_request(self, record):
+        self.failed_request_log.append(record)
 
     def add_response(self, response):
-        self.response_log.append(response)
+        self._capture(result.parse_response(response), self.response_log)
+
+    def reserve_response_record(self):
+        return self.response_log.reserve()
+
+    def set_response_record(self, index, record):
+        self.response_log.set(index, record)
+
+    async def get_requests(self):
+        await self._drain()
+        return self.request_log.records()
+
+    async def get_failed_requests(self):
+        return self.failed_request_log.records()
+
+    async def get_responses(self):
+        await self._drain()
+        return self.response_log.records()
+
+    async def discard_spilled(self):
+        """
+        Removes the spilled records once they are part of the result (the records are read lazily, see Records).
+        """
+        for log in (self.request_log, self.failed_request_log, self.response_log):
+            await log.discard_spilled()
+
+    def _capture(self, serialize, log):
+        # reserve the slot to keep the order of the events
+        index = log.reserve()
+        task = asyncio.create_task(self._serialize(serialize, log, index))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _serialize(self, serialize, log, index):
+        async with self._capture_semaphore:
+            try:
+                log.set(index, await serialize)
+            except Exception as e:
+                # e.g. the frame of the request was detached in the meantime
+                logger.warning(f'Could not serialize network event: {e}')
+                log.discard(index)
+
+    async def _drain(self):
+        while self._pending:
+            await asyncio.gather(*self._pending)
 
     def add_screenshot_path(self, path):
         self.screenshots.append(str(path))
@@ -2,22 +2,34 @@ import atexit
 import json
 import logging
 import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, Response, request, send_from_directory
+from flask import Flask, Response, request, send_file
 from flask_sock import Sock
 from podman.errors import PodmanError
 
+import catalog
 import config
+import har_writer
 import logs
+import metrics
+import podman_container
 import result
 import scanner_messages
-from errors import ScannerError
+from admission import AdmissionController, hosts_capacity
+from errors import AdmissionError, ScannerError, ScannerInitError
+from container_pool import ContainerPool
 from interactive_scanner import InteractiveScanner
-from podman_container import run_container, podman_available, stop_container, kill_old_containers
+from replay_batch import ReplayBatch
+from podman_container import podman_available, kill_old_containers
+from shared_browser import SharedBrowser
 from result import ResultKey
 from scanner_messages import ScannerMessage, MessageType
+from scanner_options import ScannerOptions
 
 # Init logging
 logs.configure('scan_manager.log')
@@ -28,6 +40,34 @@ socket_connections = dict()
 # Init set of scanners (dict access is thread-safe https://docs.python.org/3/glossary.html#term-global-interpreter-lock)
 scanners = dict()
 
+# Init executor for container startup and scanner setup, see start_scan
+STARTUP_WORKERS = 10
+startup_executor = ThreadPoolExecutor(max_workers=STARTUP_WORKERS, thread_name_prefix='scan_startup')
+atexit.register(lambda: startup_executor.shutdown(wait=False, cancel_futures=True))
+
+# Init admission control, limits the number of concurrent scans
+admission_controller = AdmissionController(
+    config.admission.getint('max_scans', fallback=0) or hosts_capacity(podman_container.get_hosts(),
+                                                                       podman_container.CONTAINER_CPUS,
+                                                                       podman_container.CONTAINER_MEMORY),
+    config.admission.getint('max_queue', fallback=20),
+    config.admission.getint('max_wait', fallback=300))
+
+# Init replay batches, see replay_batch
+replay_batches = dict()
+# seconds finished scanners and replay batches are kept (e.g. for GET /replay_batch/<batch_id>), see prune_finished
+RETENTION = 60 * 60
+
+# Convert the HAR parts of scanners terminated abnormally (before any scan runs, see har_writer)
+har_writer.recover_parts(result.RESULT_PATH)
+
+# Init the scan catalog, an empty catalog (e.g. new or deleted) is built from the result folders
+catalog_empty = catalog.init()
+# Compact the journals of scanners terminated abnormally, their runs are no longer active (see result.Result)
+result.recover_journals()
+if catalog_empty:
+    logger.info(f'Catalog rebuilt, {result.rebuild_catalog()} scans indexed.')
+
 # Init flask app
 app = Flask(__name__)
 app.secret_key = config.flask['secret_key']
@@ -37,10 +77,25 @@ sock = Sock(app)
 # Init CRON Job, see kill_old_containers
 scheduler = BackgroundScheduler()
 scheduler.add_job(func=kill_old_containers, trigger="interval", seconds=60)
+# prune_finished is defined below
+scheduler.add_job(func=lambda: prune_finished(), trigger="interval", seconds=60)
 scheduler.start()
 # Stop scheduler at exist
 atexit.register(lambda: scheduler.shutdown())
 
+# Init pool of pre-started containers
+container_pool = ContainerPool(config.pool.getint('size', fallback=0),
+                               config.pool.getint('max_idle_age', fallback=240))
+container_pool.start()
+atexit.register(container_pool.shutdown)
+
+# Init container profile of replays (headless by default, replays need no VNC screen)
+replay_profile = podman_container.PROFILES[config.replay.get('profile', fallback='headless')]
+
+# Init shared browser containers hosting several browser contexts (used for replays)
+shared_browser = SharedBrowser(config.shared_browser.getint('max_contexts', fallback=0), replay_profile)
+atexit.register(shared_browser.shutdown)
+
 
 @app.before_request
 def before_request():
@@ -60,6 +115,10 @@ def start_scan():
     Starts a scanning instance which includes the container and a chrome manager subprocess.
     The subprocess is instructed through a message queue.
     The initial scan is executed.
+
+    The container is started in the background, this request only returns a scan handle.
+    VNC port and container id are sent through the client socket as soon as the container is running.
+    The optional "options" configure the scanner (see ScannerOptions).
     """
     logger.debug('start_scan')
     # Fail fast
@@ -78,26 +137,83 @@ def start_scan():
         logger.error(msg)
         return Response(msg, status=400)
 
-    # Start container
     try:
-        container = run_container()
-    except PodmanError as e:
-        msg = str(e)
-        logger.error(msg)
-        return Response(msg, status=503)
+        options = ScannerOptions.from_json(request.json.get('options'))
+    except ScannerInitError as e:
+        return Response(f'Client Error: {e}', status=400)
 
-    # Start scanner thread
-    scanner = InteractiveScanner(url, container.devtools_port, container.id, None, socket)
-    scanners[container.id] = scanner
-    scanner.start()
+    try:
+        ticket = admission_controller.enqueue()
+    except AdmissionError as e:
+        return admission_rejected(e)
+    queue_position = admission_controller.position(ticket)
 
-    # Start initial scan
-    scanner.put_msg(ScannerMessage(MessageType.StartScan))
+    scan_handle = secrets.token_hex(8)
+    startup_executor.submit(start_interactive_scanner, scan_handle, url, options, socket, ticket)
 
     # Respond
-    response_body = json.dumps(
-        {"vnc_port": container.vnc_port, "container_id": container.id})
-    return Response(response_body, status=200)
+    response_body = json.dumps({"scan_handle": scan_handle, "queue_position": queue_position})
+    return Response(response_body, status=202)
+
+
+def start_interactive_scanner(scan_handle, url, options, socket, ticket):
+    """
+    Starts container and scanner of an interactive scan and informs the client through its socket.
+    Runs in the startup executor, errors are therefore handled here: until the scanner runs, the admission slot and
+    the container are released on any error and the client receives a SocketError.
+    """
+    admitted = False
+    container = None
+    scanner_started = False
+    try:
+        # Wait for a free slot
+        admission_controller.wait(ticket,
+                                  on_position=lambda p: socket.send(json.dumps({"QueuePosition": str(p)})))
+        admitted = True
+
+        # Start container and scanner
+        container = container_pool.lease()
+        scanner = InteractiveScanner(url, container, options, socket)
+        scanner.add_completion_callback(admission_controller.release)
+        scanners[container.id] = scanner
+        scanner.start()
+        # the scanner releases container and slot from now on
+        scanner_started = True
+
+        # Start initial scan
+        scanner.put_msg(ScannerMessage(MessageType.StartScan))
+
+        # socket messages map to a string (see frontend Scan.Data), the start info is therefore encoded separately
+        started = {"scan_handle": scan_handle,
+                   "vnc_host": container.address,
+                   "vnc_port": container.vnc_port,
+                   "container_id": container.id}
+        socket.send(json.dumps({"ScanStarted": json.dumps(started)}))
+    except Exception as e:
+        if isinstance(e, (AdmissionError, PodmanError, ScannerInitError)):
+            logger.error(f'Scan {scan_handle} could not be started: {e}')
+        else:
+            # unexpected, e.g. the client disconnected or a ScannerError
+            logger.exception(f'Scan {scan_handle} could not be started: {e!r}')
+        if scanner_started:
+            _abort_startup(socket, e, None, False)
+        else:
+            _abort_startup(socket, e, container, admitted)
+
+
+def _abort_startup(socket, error, container, release_slot):
+    if container is not None:
+        try:
+            container.release()
+        except PodmanError as e:
+            logger.error(f'Could not release container {container.id}: {e}')
+    if release_slot:
+        admission_controller.release()
+    try:
+        socket.send(json.dumps({"SocketError": f"Scan could not be started: {error}"}))
+    except Exception as e:
+        # e.g. the client disconnected
+        logger.debug(f'Could not inform client: {e!r}')
 
 
 @app.route('/register_interaction', methods=['POST'])
@@ -163,19 +279,28 @@ def add_socket(socket):
 
 @app.route('/status', methods=['GET'])
 def status():
-    for s in scanners:
+    for s in list(scanners):
         s.send_socket_msg('asdf')
     return Response("server up", status=200)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns the distribution of the recorded metrics, e.g. the time until new containers are ready.
+    """
+    response_body = json.dumps(metrics.summary(), sort_keys=True)
+    return Response(response_body, status=200)
+
+
 @app.route('/stop_all_scans', methods=['POST'])
 def stop_all_scans():
     """
     Used for debugging purposes.
     """
-    for c_id, scanner in scanners.items():
+    for scanner in list(scanners.values()):
         try:
-            stop_container(c_id)
+            scanner.container.release()
             scanner.put_msg(ScannerMessage(MessageType.StopScan))
         except PodmanError as e:
             return Response(f'Server Error: {e}', status=500)
@@ -186,27 +311,86 @@ def stop_all_scans():
 
 @app.route('/get_all_scans', methods=['GET'])
 def get_all_scans():
-    scans = result.get_all_scans()
+    # werkzeug ignores conversion errors of request.args.get(type=...), invalid values are rejected here
+    try:
+        limit = _optional_arg('limit', _non_negative_int)
+        offset = _optional_arg('offset', _non_negative_int) or 0
+        success = _optional_arg('success', _bool_arg)
+    except ValueError as e:
+        return Response(f'Client Error: {e}', status=400)
+    scans, total = result.get_all_scans(limit, offset, request.args.get('site'), success)
     response_body = json.dumps(scans, sort_keys=True)
-    return Response(response_body, status=200)
+    return Response(response_body, status=200, headers={'X-Total-Count': str(total)})
+
+
+def _non_negative_int(value):
+    if not value.isdigit():
+        raise ValueError(f'{value} is not a non-negative integer.')
+    return int(value)
+
+
+def _bool_arg(value):
+    if value not in ('true', 'false'):
+        raise ValueError(f'{value} is not a boolean (true or false).')
+    return value == 'true'
+
+
+def _utc_timestamp(value):
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        # independent of the timezone of the server
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def _optional_arg(name, convert):
+    value = request.args.get(name)
+    return None if value is None else convert(value)
 
 
 @app.route("/result/<path:scan_id>")
 def download_file(scan_id):
     logger.info(f'requested folder {scan_id}')
-    path = result.archive_result(scan_id)
-    return send_from_directory(
-        result.DOWNLOAD_PATH, path, as_attachment=True
-    )
+    archive = result.cached_archive(scan_id)
+    if archive is not None:
+        # conditional responses support range requests
+        return send_file(archive.resolve(), as_attachment=True, download_name=f'{scan_id}.zip', conditional=True)
+    try:
+        chunks = result.stream_result(scan_id)
+    except ScannerError as e:
+        return Response(f'Client Error: {e}', status=404)
+    return _zip_response(chunks, f'{scan_id}.zip')
 
 
 @app.route("/results")
 def download_results():
     logger.info('requested all results')
-    path = result.archive_all_results()
-    return send_from_directory(
-        result.DOWNLOAD_PATH, path, as_attachment=True
-    )
+    filename, chunks = result.stream_all_results()
+    return _zip_response(chunks, filename)
+
+
+@app.route("/export")
+def export_results():
+    """
+    Exports the scans changed after either the cursor of the previous export (cursor=<catalog seq>)
+    or an ISO 8601 timestamp (since=<timestamp>, UTC unless it has an offset). All scans are exported without either.
+    """
+    try:
+        cursor = _optional_arg('cursor', _non_negative_int)
+        since = _optional_arg('since', _utc_timestamp)
+    except ValueError as e:
+        return Response(f'Client Error: {e}', status=400)
+    if cursor is not None and since is not None:
+        return Response('Client Error: cursor and since are mutually exclusive.', status=400)
+    logger.info(f'requested export after cursor {cursor} / since {since}')
+    filename, chunks = result.export_results(after_cursor=cursor, updated_after=since)
+    return _zip_response(chunks, filename)
+
+
+def _zip_response(chunks, filename):
+    # the archive is created while it is sent
+    return Response(chunks, mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 @app.route('/replay_scan', methods=['POST'])
@@ -216,34 +400,109 @@ def replay_scan():
         return Response('Client Error: Request must be a JSON', status=400)
     result_id = request.json['result_id']
     try:
-        scan_info = result.get_scan_info(result_id)
+        options = ScannerOptions.from_json(request.json.get('options'))
+    except ScannerInitError as e:
+        return Response(f'Client Error: {e}', status=400)
+    try:
+        scanner = start_replay(result_id, options=options)
+    except AdmissionError as e:
+        return admission_rejected(e)
     except ScannerError as e:
         return Response(f'Client Error, result not found: {e}')
-
-    # Start container
-    try:
-        container = run_container()
     except PodmanError as e:
         msg = str(e)
         logger.error(msg)
         return Response(msg, status=503)
 
-    scanner = InteractiveScanner(scan_info[ResultKey.SITE_URL],
-                                 container.devtools_port,
-                                 container.id,
-                                 None,
-                                 None,
-                                 reference_scan_id=result_id)
+    # Respond
+    container = scanner.container
+    response_body = json.dumps({"vnc_host": container.address, "vnc_port": container.vnc_port,
+                                "container_id": container.id})
+    return Response(response_body, status=200)
+
+
+@app.route('/replay_batch', methods=['POST'])
+def replay_batch():
+    """
+    Replays several results, the request contains a list of result ids (or "all"),
+    an optional concurrency and optional scanner options applied to all replays.
+    Progress is reported by GET /replay_batch/<batch_id>.
+    """
+    if request.json is None:
+        return Response('Client Error: Request must be a JSON', status=400)
+    result_ids = request.json['result_ids']
+    if result_ids == 'all':
+        result_ids = result.get_result_ids()
+    elif not isinstance(result_ids, list):
+        return Response('Client Error: result_ids must be a list or "all".', status=400)
+    concurrency = request.json.get('concurrency', config.replay.getint('batch_concurrency', fallback=4))
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return Response('Client Error: concurrency must be a positive integer.', status=400)
+    try:
+        options = ScannerOptions.from_json(request.json.get('options'))
+    except ScannerInitError as e:
+        return Response(f'Client Error: {e}', status=400)
+
+    # batch replays wait for a free slot instead of being rejected
+    batch = ReplayBatch(result_ids, concurrency, lambda result_id: start_replay(result_id, wait_timeout=None, options=options))
+    replay_batches[batch.id] = batch
+    batch.start()
+    return Response(json.dumps(batch.status()), status=202)
+
+
+@app.route('/replay_batch/<batch_id>', methods=['GET'])
+def replay_batch_status(batch_id):
+    if batch_id not in replay_batches:
+        return Response(f'Client Error: Batch {batch_id} does not exist.', status=404)
+    response_body = json.dumps(replay_batches[batch_id].status(), sort_keys=True)
+    return Response(response_body, status=200)
+
+
+def start_replay(result_id, wait_timeout=0, options=None):
+    """
+    Starts the replay of the first scan of a result, the replay is stored as recorded scan of the result.
+    :param wait_timeout: max seconds to wait for a free slot (0 rejects immediately, None waits up to max_wait)
+    :param options: ScannerOptions of the replay, None uses the defaults
+    :return: the started scanner
+    :raises AdmissionError: if no slot is available in time
+    :raises ScannerError: if the result does not exist
+    :raises PodmanError: if no container could be started
+    """
+    scan_info = result.get_scan_info(result_id)
+
+    ticket = admission_controller.enqueue()
+    admission_controller.wait(ticket, timeout=wait_timeout)
+    container = None
+    try:
+        # Start container or lease a browser context in a shared container
+        if shared_browser.enabled():
+            container = shared_browser.lease()
+        elif replay_profile is podman_container.INTERACTIVE:
+            container = container_pool.lease()
+        else:
+            container = podman_container.run_container(replay_profile)
+
+        scanner = InteractiveScanner(scan_info[ResultKey.SITE_URL],
+                                     container,
+                                     options,
+                                     None,
+                                     reference_scan_id=result_id)
+    except Exception:
+        if container is not None:
+            try:
+                container.release()
+            except PodmanError as e:
+                logger.error(f'Could not release container {container.id}: {e}')
+        admission_controller.release()
+        raise
+    scanner.add_completion_callback(admission_controller.release)
     scanners[container.id] = scanner
     scanner.start()
 
     # Define sequence
     for m in scanner_message_sequence(scan_info[ResultKey.INTERACTION]):
         scanner.put_msg(m)
-
-    # Respond
-    response_body = json.dumps({"vnc_port": container.vnc_port})
-    return Response(response_body, status=200)
+    return scanner
 
 
 def scanner_message_sequence(interaction):
@@ -260,6 +519,24 @@ def scanner_message_sequence(interaction):
     return message_sequence
 
 
+def prune_finished():
+    """
+    Removes scanners and replay batches which finished more than RETENTION seconds ago.
+    """
+    deadline = time.monotonic() - RETENTION
+    for container_id, scanner in list(scanners.items()):
+        if scanner.completed_at is not None and scanner.completed_at < deadline:
+            scanners.pop(container_id, None)
+    for batch_id, batch in list(replay_batches.items()):
+        end_time = batch.end_time()
+        if end_time is not None and end_time < deadline:
+            replay_batches.pop(batch_id, None)
+
+
+def admission_rejected(error):
+    return Response(f'Server Busy: {error}', status=503, headers={'Retry-After': str(error.retry_after)})
+
+
 def get_scanner():
     if request.json is None:
         raise ValueError("Request must be JSON containing the container id.")
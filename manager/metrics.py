@@ -0,0 +1,34 @@
+import statistics
+from collections import defaultdict, deque
+from threading import Lock
+
+# number of samples kept per metric
+MAX_SAMPLES = 1000
+
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_lock = Lock()
+
+
+def record(name, value):
+    """
+    Records one observation (e.g. a duration in seconds) of the metric with the given name.
+    """
+    with _lock:
+        _samples[name].append(value)
+
+
+def summary():
+    """
+    Returns the distribution of the recorded observations for every metric.
+    """
+    with _lock:
+        samples = {name: sorted(values) for name, values in _samples.items()}
+    return {name: _describe(values) for name, values in samples.items() if values}
+
+
+def _describe(values):
+    return {'count': len(values),
+            'min': values[0],
+            'median': statistics.median(values),
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max': values[-1]}
@@ -0,0 +1,154 @@
+import copy
+
+import logs
+
+logger = logs.get_logger('network_recorder')
+
+
+class NetworkRecorder:
+    """
+    Records requests and responses from CDP Network events.
+
+    The records have the shape of result.parse_request / result.parse_response,
+    but are built from the event payloads without further round trips to the browser.
+    Records are completed by later events (e.g. raw headers), their slot in the page is therefore reserved
+    when the request is sent (keeping the order of the events) and set once the request finished (see CaptureBuffer).
+
+    :param get_page: returns the page the records are added to (the page changes with every interaction)
+    """
+
+    def __init__(self, browser, get_page):
+        self.browser = browser
+        self._get_page = get_page
+        # request id -> pending request record of requests in flight
+        self._requests = dict()
+        # request id -> pending response record of responses in flight
+        self._responses = dict()
+        # request id -> raw headers received before the request / response itself
+        self._request_extra_headers = dict()
+        self._response_extra_headers = dict()
+
+    def register(self):
+        # Network.enable is sent in InteractiveScanner._register_callbacks
+        self.browser.register_event('Network.requestWillBeSent', self._request_will_be_sent)
+        self.browser.register_event('Network.requestWillBeSentExtraInfo', self._request_extra_info)
+        self.browser.register_event('Network.responseReceived', self._response_received)
+        self.browser.register_event('Network.responseReceivedExtraInfo', self._response_extra_info)
+        self.browser.register_event('Network.loadingFinished', self._loading_finished)
+        self.browser.register_event('Network.loadingFailed', self._loading_failed)
+
+    def _request_will_be_sent(self, params):
+        request_id = params['requestId']
+        if 'redirectResponse' in params and request_id in self._requests:
+            # redirects reuse the request id, the event contains the response of the previous request
+            self._add_response(request_id, params['redirectResponse'])
+            self._finish(request_id)
+
+        request = params['request']
+        record = {"url": request['url'] + request.get('urlFragment', ''),
+                  "method": request['method'],
+                  "headers": _lower_keys(request['headers']),
+                  "post_data": request.get('postData'),
+                  "document_url": params.get('documentURL')}
+        if request_id in self._request_extra_headers:
+            record['headers'] = self._request_extra_headers.pop(request_id)
+        page = self._get_page()
+        self._requests[request_id] = _Pending(record, page, page.reserve_request_record())
+
+    def flush(self, page):
+        """
+        Sets the records of the page that are still in flight as they are now, e.g. before the page is extracted.
+        Later events of these requests no longer change the records of the page.
+        """
+        for pending in self._requests.values():
+            if pending.page is page:
+                page.set_request_record(pending.index, copy.deepcopy(pending.record))
+                pending.page = None
+        for pending in self._responses.values():
+            if pending.page is page:
+                page.set_response_record(pending.index, copy.deepcopy(pending.record))
+                pending.page = None
+
+    def _request_extra_info(self, params):
+        # raw headers including cookies, as returned by playwright's all_headers()
+        headers = _lower_keys(params['headers'])
+        if params['requestId'] in self._requests:
+            self._requests[params['requestId']].record['headers'] = headers
+        else:
+            self._request_extra_headers[params['requestId']] = headers
+
+    def _response_received(self, params):
+        self._add_response(params['requestId'], params['response'])
+
+    def _response_extra_info(self, params):
+        headers = _lower_keys(params['headers'])
+        if params['requestId'] in self._responses:
+            self._responses[params['requestId']].record['headers'] = headers
+        else:
+            self._response_extra_headers[params['requestId']] = headers
+
+    def _loading_finished(self, params):
+        self._finish(params['requestId'])
+
+    def _loading_failed(self, params):
+        request_id = params['requestId']
+        pending = self._requests.get(request_id)
+        if pending is not None:
+            request = pending.record
+            self._get_page().add_failed_request({"url": request['url'],
+                                                 "method": request['method'],
+                                                 "error": params.get('errorText'),
+                                                 "canceled": params.get('canceled', False),
+                                                 "blocked_reason": params.get('blockedReason')})
+        self._finish(request_id)
+
+    def _add_response(self, request_id, response):
+        pending = self._requests.get(request_id)
+        if pending is None:
+            # e.g. requests sent before the recorder was registered
+            return
+        record = {"url": response['url'],
+                  "request": pending.record,
+                  "headers": self._response_extra_headers.pop(request_id, None) or _lower_keys(response['headers']),
+                  "status": response['status'],
+                  "security": _security_details(response.get('securityDetails'))}
+        page = self._get_page()
+        self._responses[request_id] = _Pending(record, page, page.reserve_response_record())
+
+    def _finish(self, request_id):
+        # the records are complete
+        request = self._requests.pop(request_id, None)
+        if request is not None and request.page is not None:
+            request.page.set_request_record(request.index, request.record)
+        response = self._responses.pop(request_id, None)
+        if response is not None and response.page is not None:
+            response.page.set_response_record(response.index, response.record)
+        self._request_extra_headers.pop(request_id, None)
+        self._response_extra_headers.pop(request_id, None)
+
+
+class _Pending:
+    """
+    A record in flight and its reserved slot, page is None once the record was flushed.
+    """
+
+    def __init__(self, record, page, index):
+        self.record = record
+        self.page = page
+        self.index = index
+
+
+def _lower_keys(headers):
+    # playwright returns header names in lower case
+    return {name.lower(): value for name, value in headers.items()}
+
+
+def _security_details(details):
+    # subset returned by playwright's security_details()
+    if details is None:
+        return None
+    return {"issuer": details.get('issuer'),
+            "protocol": details.get('protocol'),
+            "subjectName": details.get('subjectName'),
+            "validFrom": details.get('validFrom'),
+            "validTo": details.get('validTo')}
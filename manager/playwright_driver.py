@@ -0,0 +1,120 @@
+import asyncio
+
+import playwright.async_api as async_api
+from playwright.async_api import async_playwright
+
+import logs
+
+# seconds the driver keeps running without any connected browser
+DRIVER_IDLE_TIMEOUT = 10 * 60
+
+logger = logs.get_logger('playwright_driver')
+
+
+class PlaywrightDriver:
+    """
+    A single playwright driver process shared by all browsers of the scanner runtime.
+
+    The driver is started on first use and restarted if it died.
+    Connected browsers are reference counted, an unused driver is stopped after DRIVER_IDLE_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._context_manager = None
+        self._playwright = None
+        # incremented on every start, see connect_over_cdp
+        self._generation = 0
+        self._refs = 0
+        # browsers connected through the driver
+        self._browsers = set()
+        self._idle_timer = None
+        self._lock = asyncio.Lock()
+
+    async def connect_over_cdp(self, endpoint_url):
+        """
+        Connects to a browser through the shared driver, every connection must be released with release().
+        """
+        async with self._lock:
+            self._cancel_idle_timer()
+            if not self._alive():
+                await self._start()
+            self._refs += 1
+            generation = self._generation
+        try:
+            try:
+                browser = await self._playwright.chromium.connect_over_cdp(endpoint_url)
+            except async_api.Error:
+                async with self._lock:
+                    # another connection might have restarted the driver already
+                    if self._generation == generation:
+                        if self._browsers and self._alive():
+                            raise
+                        # reconnect once, the driver might have died during the connection attempt
+                        logger.warning('Connection failed, restarting playwright driver.')
+                        await self._start()
+                browser = await self._playwright.chromium.connect_over_cdp(endpoint_url)
+        except BaseException:
+            await self.release()
+            raise
+        self._browsers.add(browser)
+        return browser
+
+    async def release(self, browser=None):
+        """
+        Releases a connection (see connect_over_cdp), browser is None if the connection failed.
+        """
+        async with self._lock:
+            self._browsers.discard(browser)
+            self._refs -= 1
+            if self._refs == 0:
+                self._cancel_idle_timer()
+                self._idle_timer = asyncio.get_running_loop().call_later(
+                    DRIVER_IDLE_TIMEOUT, lambda: asyncio.ensure_future(self._stop_if_idle()))
+
+    def _cancel_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _alive(self):
+        if self._playwright is None:
+            return False
+        # playwright offers no API to check the driver process, but every browser connected through a dead driver
+        # is disconnected (without connected browsers the driver is assumed to be alive)
+        return not self._browsers or any(browser.is_connected() for browser in self._browsers)
+
+    async def _start(self):
+        await self._stop()
+        self._context_manager = async_playwright()
+        self._playwright = await self._context_manager.start()
+        self._generation += 1
+        logger.info('Playwright driver started.')
+
+    async def _stop(self):
+        if self._playwright is None:
+            return
+        try:
+            await self._playwright.stop()
+        except Exception as e:
+            logger.warning(f'Could not stop playwright driver: {e}')
+        self._context_manager = None
+        self._playwright = None
+        # browsers of a stopped driver are disconnected
+        self._browsers.clear()
+        logger.info('Playwright driver stopped.')
+
+    async def _stop_if_idle(self):
+        async with self._lock:
+            if self._refs == 0:
+                await self._stop()
+
+
+_driver = PlaywrightDriver()
+
+
+async def connect_over_cdp(endpoint_url):
+    return await _driver.connect_over_cdp(endpoint_url)
+
+
+async def release(browser=None):
+    await _driver.release(browser)
@@ -1,45 +1,187 @@
+import json
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from urllib.error import URLError
+from urllib.request import urlopen
 
 from podman import PodmanClient
 from podman.errors import PodmanError, BuildError, NotFound, APIError
 
 import config
 import logs
+import metrics
 
 CHROME_IMAGE_TAG = "chrome_scan"
+HEADLESS_IMAGE_TAG = "chrome_scan_headless"
 VNC_PORT = 5900
 DEVTOOLS_PORT = 9000
 
 PODMAN_SOCKET_URI = "unix://" + config.podman['podman_socket']
+# prefix of config sections describing additional podman hosts, e.g. [podman:worker1]
+PODMAN_HOST_SECTION_PREFIX = 'podman:'
+# name of the host configured in the [podman] section
+LOCAL_HOST = 'local'
+# max number of scan containers per host if not configured
+DEFAULT_HOST_CAPACITY = 20
 
 # max lifetime in seconds (5 Minutes)
 CONTAINER_MAX_LIFETIME = 60 * 5
 
+# resource limits of every scan container (see [admission] in manager.cfg)
+CONTAINER_CPUS = config.admission.getfloat('cpus_per_scan', fallback=1.0)
+CONTAINER_MEMORY = config.admission.getint('memory_per_scan', fallback=3072) * 2 ** (10 * 2)
+CPU_PERIOD = 100000
+
+# labels attached to every scan container, used to find the containers owned by this manager
+OWNER_LABEL = 'privacyscanner.owner'
+OWNER = 'interactive_privacyscanner'
+STARTED_AT_LABEL = 'privacyscanner.started_at'
+# number of containers stopped concurrently by the reaper
+REAPER_WORKERS = 8
+
+# max time in seconds until the devtools endpoint of a new container must respond
+DEVTOOLS_READY_TIMEOUT = 30
+# first and max delay in seconds between two readiness probes (exponential backoff)
+PROBE_INITIAL_DELAY = 0.1
+PROBE_MAX_DELAY = 1
+# timeout in seconds of a single readiness probe
+PROBE_TIMEOUT = 1
+
 logger = logs.get_logger('podman_api')
 
-# libpod rootless service unix domain socket
-# (see https://docs.podman.io/en/latest/markdown/podman-system-service.1.html)
-podman_client = PodmanClient(base_url=PODMAN_SOCKET_URI, version="2.0")
+
+class PodmanHost:
+    """
+    A podman service on which scan containers are placed.
+
+    The client only needs to provide the used subset of the PodmanClient API (ping, images, containers),
+    hosts can therefore be backed by several local podman services or by a fake client in tests.
+    """
+
+    def __init__(self, name, client, address, capacity):
+        self.name = name
+        self.client = client
+        # address under which the mapped container ports are reachable
+        self.address = address
+        self.capacity = capacity
+        # ids of the running scan containers
+        self.containers = set()
+        # number of containers currently being started
+        self.reserved = 0
+
+    def load(self):
+        return (len(self.containers) + self.reserved) / self.capacity
+
+    def has_capacity(self):
+        return len(self.containers) + self.reserved < self.capacity
+
+    def available(self):
+        try:
+            return self.client.ping()
+        except APIError as e:
+            logger.error(f'Podman host {self.name} not available: {e}')
+            return False
+
+    def __str__(self):
+        return f'{self.name} ({len(self.containers)}/{self.capacity} containers)'
+
+
+def _init_hosts():
+    # libpod rootless service unix domain socket
+    # (see https://docs.podman.io/en/latest/markdown/podman-system-service.1.html)
+    hosts = [PodmanHost(LOCAL_HOST,
+                        PodmanClient(base_url=PODMAN_SOCKET_URI, version="2.0"),
+                        'localhost',
+                        config.podman.getint('capacity', fallback=DEFAULT_HOST_CAPACITY))]
+    for name, section in config.sections(PODMAN_HOST_SECTION_PREFIX).items():
+        hosts.append(PodmanHost(name,
+                                PodmanClient(base_url=section['podman_uri'], version="2.0"),
+                                section['address'],
+                                section.getint('capacity', fallback=DEFAULT_HOST_CAPACITY)))
+    return hosts
+
+
+_hosts = _init_hosts()
+# container id -> host the container was placed on
+_container_hosts = dict()
+_placement_lock = Lock()
+
+# Time (epoch seconds) at which a pre-started container was handed to a scan, see mark_leased
+_lease_times = dict()
+# ids of containers that are not subject to the max lifetime (e.g. shared browser containers)
+_long_lived = set()
+
+
+class ContainerProfile:
+    def __init__(self, name, image_tag, dockerfile, ports, shm_size):
+        self.name = name
+        self.image_tag = image_tag
+        self.dockerfile = dockerfile
+        # container ports mapped to the host
+        self.ports = ports
+        # size of /dev/shm in bytes
+        self.shm_size = shm_size
+
+
+# Chromium on a virtual screen which is shared through VNC (interactive scans)
+INTERACTIVE = ContainerProfile('interactive', CHROME_IMAGE_TAG, 'Dockerfile',
+                               (VNC_PORT, DEVTOOLS_PORT), 2 * 2 ** (10 * 3))  # 2gb
+# Headless chromium without X server and VNC (replays)
+HEADLESS = ContainerProfile('headless', HEADLESS_IMAGE_TAG, 'Dockerfile.headless',
+                            (DEVTOOLS_PORT,), 512 * 2 ** (10 * 2))  # 512mb
+PROFILES = {profile.name: profile for profile in (INTERACTIVE, HEADLESS)}
+
+
+def configure_hosts(hosts):
+    """
+    Replaces the configured podman hosts, e.g. by hosts with fake clients (see test_podman_container.py).
+    """
+    global _hosts
+    with _placement_lock:
+        _hosts = list(hosts)
+        _container_hosts.clear()
 
 
 class Container:
-    def __init__(self, container_id, name, labels, vnc_port, devtools_port):
+    def __init__(self, container_id, name, labels, address, vnc_port, devtools_port):
         self.id = container_id
         self.name = name
         self.labels = labels
+        self.address = address
         self.vnc_port = vnc_port
         self.devtools_port = devtools_port
+        # seconds from container start until the devtools endpoint responded
+        self.ready_time = None
+
+    def release(self):
+        """
+        Called by the scanner once the scan is complete.
+        """
+        stop_container(self.id)
+
+
+def get_hosts():
+    """
+    Returns the configured podman hosts.
+    """
+    with _placement_lock:
+        return list(_hosts)
 
 
 def build_container_image():
     os.chdir("../chrome_container")
     logger.info("Building Container image.")
     try:
-        image, logs = podman_client.images.build(
-            path=".", dockerfile="Dockerfile", nocache=False, tag=CHROME_IMAGE_TAG
-        )
-        return {"image": str(image), "logs": logs}
+        images = dict()
+        for host in _hosts:
+            for profile in PROFILES.values():
+                image, logs = host.client.images.build(
+                    path=".", dockerfile=profile.dockerfile, nocache=False, tag=profile.image_tag
+                )
+                images[f'{host.name}/{profile.name}'] = {"image": str(image), "logs": logs}
+        return images
     except BuildError as e:
         logger.error("Build failed, exiting.")
         raise PodmanError(e)
@@ -47,15 +189,53 @@ def build_container_image():
         os.chdir("..")
 
 
-def run_container():
-    if not podman_client.images.exists(CHROME_IMAGE_TAG):
-        raise PodmanError("Chrome image does not exist.")
-    port_mapping = {
-        (str(VNC_PORT) + "/tcp"): None,
-        (str(DEVTOOLS_PORT) + "/tcp"): None,
+def run_container(profile=INTERACTIVE, long_lived=False):
+    """
+    Starts a scan container on the least loaded podman host.
+    :param profile: container profile, see INTERACTIVE and HEADLESS
+    :param long_lived: exclude the container from the max lifetime, it must be stopped by the caller
+    """
+    host = _reserve_host()
+    try:
+        container = _run_container_on(host, profile)
+    finally:
+        with _placement_lock:
+            host.reserved -= 1
+    with _placement_lock:
+        host.containers.add(container.id)
+        _container_hosts[container.id] = host
+    if long_lived:
+        _long_lived.add(container.id)
+    return container
+
+
+def _reserve_host():
+    with _placement_lock:
+        candidates = sorted((h for h in _hosts if h.has_capacity()), key=lambda h: h.load())
+    for host in candidates:
+        if not host.available():
+            continue
+        with _placement_lock:
+            # capacity might have been taken in the meantime
+            if host.has_capacity():
+                host.reserved += 1
+                logger.debug(f'Placing container on podman host {host}.')
+                return host
+    raise PodmanError('No podman host with free capacity available.')
+
+
+def _run_container_on(host, profile):
+    if not host.client.images.exists(profile.image_tag):
+        raise PodmanError(f"Chrome image {profile.image_tag} does not exist on podman host {host.name}.")
+    port_mapping = {(str(port) + "/tcp"): None for port in profile.ports}
+    labels = {
+        OWNER_LABEL: OWNER,
+        STARTED_AT_LABEL: str(int(time.time())),
     }
-    container = podman_client.containers.run(
-        image=CHROME_IMAGE_TAG,
+    container = host.client.containers.run(
+        image=profile.image_tag,
+        # labels (Union[Dict[str, str], List[str]): A dictionary of name-value labels.
+        labels=labels,
         # ports (Dict[str, Union[int, Tuple[str, int], List[int]]]): Ports to bind inside the container.
         ports=port_mapping,
         # remove (bool): Remove the container when it has finished running. Default: False.
@@ -63,23 +243,44 @@ def run_container():
         # detach (bool): Run container in the background and return a Container object.
         detach=True,
         # shm_size (Union[str, int]): Size of /dev/shm (e.g. 1G).
-        shm_size=2 * 2 ** (10 * 3)  # 2gb, str does not work for some reason
+        shm_size=profile.shm_size,  # str does not work for some reason
+        # mem_limit (Union[int, str]): Memory limit in bytes.
+        mem_limit=CONTAINER_MEMORY,
+        # cpu_period (int): The length of a CPU period in microseconds.
+        cpu_period=CPU_PERIOD,
+        # cpu_quota (int): Microseconds of CPU time that the container can get in a CPU period.
+        cpu_quota=int(CONTAINER_CPUS * CPU_PERIOD),
     )
 
     if container.status != "running":
         raise PodmanError('Container is not running.')
 
-    logger.info(f"Started new container instance. (container id={container.id})")
+    logger.info(f"Started new {profile.name} container instance on {host.name}. (container id={container.id})")
     ports = _get_host_ports(container)
-    if VNC_PORT not in ports or DEVTOOLS_PORT not in ports:
+    if any(port not in ports for port in profile.ports):
         raise PodmanError(f"Container port mapping invalid. (status={container.status})")
 
-    return Container(container.id, container.name, container.labels, ports[VNC_PORT], ports[DEVTOOLS_PORT])
+    started = Container(container.id, container.name, container.labels, host.address,
+                        ports.get(VNC_PORT), ports[DEVTOOLS_PORT])
+    try:
+        started.ready_time = wait_until_ready(started.address, started.devtools_port)
+    except PodmanError:
+        container.stop(timeout=5)
+        raise
+    metrics.record('container_ready_seconds', started.ready_time)
+    logger.info(f"Container ready after {started.ready_time:.2f} seconds. (container id={container.id})")
+    return started
 
 
 def stop_container(container_id):
+    _lease_times.pop(container_id, None)
+    _long_lived.discard(container_id)
+    host = _get_host(container_id)
+    with _placement_lock:
+        host.containers.discard(container_id)
+        _container_hosts.pop(container_id, None)
     try:
-        container = podman_client.containers.get(container_id)
+        container = host.client.containers.get(container_id)
     except NotFound as e:
         raise PodmanError(e)
 
@@ -89,29 +290,130 @@ def stop_container(container_id):
         raise PodmanError('Container is not running.')
 
 
-def podman_available():
+def is_running(container_id):
     """
-    Returns True if Podman service is running correctly.
+    Returns True if the container still exists and is running.
     """
     try:
-        return podman_client.ping()
-    except APIError as e:
-        logger.error(f'Error {e}')
+        container = _get_host(container_id).client.containers.get(container_id)
+    except (NotFound, PodmanError):
         return False
+    return container.status == "running"
+
+
+def _get_host(container_id):
+    if container_id in _container_hosts:
+        return _container_hosts[container_id]
+    # e.g. containers started before a restart of the manager
+    for host in _hosts:
+        if host.client.containers.exists(container_id):
+            return host
+    raise PodmanError(f'Container {container_id} not found on any podman host.')
+
+
+def mark_leased(container_id):
+    """
+    Restarts the lifetime of a pre-started container once it is handed to a scan.
+    """
+    _lease_times[container_id] = time.time()
+
+
+def probe_devtools(address, devtools_port):
+    """
+    Returns True if Chromium answers on the devtools endpoint (exposed through the socat proxy).
+    """
+    try:
+        with urlopen(f'http://{address}:{devtools_port}/json/version', timeout=PROBE_TIMEOUT) as response:
+            return 'webSocketDebuggerUrl' in json.load(response)
+    except (URLError, ConnectionError, TimeoutError, ValueError):
+        # connection refused / reset while socat or chromium are still starting
+        return False
+
+
+def wait_until_ready(address, devtools_port, timeout=DEVTOOLS_READY_TIMEOUT):
+    """
+    Polls the devtools endpoint with exponential backoff until it responds.
+    :return: seconds until the endpoint was ready
+    :raises PodmanError: if the endpoint did not respond within the timeout
+    """
+    start = time.monotonic()
+    delay = PROBE_INITIAL_DELAY
+    while not probe_devtools(address, devtools_port):
+        elapsed = time.monotonic() - start
+        if elapsed >= timeout:
+            raise PodmanError(f'Browser not ready after {timeout} seconds. (devtools={address}:{devtools_port})')
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, PROBE_MAX_DELAY)
+    return time.monotonic() - start
+
+
+def podman_available():
+    """
+    Returns True if at least one Podman service is running correctly.
+    """
+    return any(host.available() for host in _hosts)
 
 
 def kill_old_containers():
-    containers = podman_client.containers.list()
-    for c in containers:
-        started_at = c.inspect()['State']['StartedAt']
-        # StartedAt does not conform to ISO date, but it has 8 instead of 6 microsecond digits
-        # e.g. '2022-06-07T15:18:51.949951782+02:00'
-        iso_started_at = started_at[:started_at.find('.')]
-        run_time = datetime.now() - datetime.fromisoformat(iso_started_at)
-        if run_time.seconds > CONTAINER_MAX_LIFETIME:
-            logger.warn(f'Container {c.id} reached its max age (30 minutes) and was shut down.')
-            c.stop()
-            c.remove()
+    """
+    Stops all scan containers of this manager that exceeded their max lifetime.
+    """
+    start = time.monotonic()
+    containers = []
+    for host in _hosts:
+        try:
+            containers += _list_host_containers(host)
+        except PodmanError as e:
+            logger.error(f'Could not list containers of podman host {host.name}: {e}')
+    now = time.time()
+    expired = [c for c in containers
+               if c.id not in _long_lived and now - _get_start_time(c) > CONTAINER_MAX_LIFETIME]
+    if expired:
+        with ThreadPoolExecutor(max_workers=REAPER_WORKERS, thread_name_prefix='reaper') as executor:
+            futures = {executor.submit(_reap_container, c): c for c in expired}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logger.error(f'Could not reap container {futures[future].id}: {future.exception()!r}')
+    duration = time.monotonic() - start
+    metrics.record('reaper_pass_seconds', duration)
+    logger.info(f'Reaper pass took {duration:.2f} seconds. ({len(expired)} of {len(containers)} containers stopped)')
+
+
+def _list_host_containers(host):
+    """
+    Lists the scan containers of a host and drops containers that terminated on their own from its bookkeeping.
+    """
+    with _placement_lock:
+        tracked = set(host.containers)
+    containers = host.client.containers.list(filters={'label': f'{OWNER_LABEL}={OWNER}'})
+    with _placement_lock:
+        for container_id in tracked - {c.id for c in containers}:
+            host.containers.discard(container_id)
+            _container_hosts.pop(container_id, None)
+    return containers
+
+
+def _get_start_time(container):
+    if container.id in _lease_times:
+        return _lease_times[container.id]
+    return int(container.labels.get(STARTED_AT_LABEL, 0))
+
+
+def _reap_container(container):
+    logger.warning(f'Container {container.id} reached its max age ({CONTAINER_MAX_LIFETIME} seconds) and was shut down.')
+    _lease_times.pop(container.id, None)
+    with _placement_lock:
+        host = _container_hosts.pop(container.id, None)
+        if host is not None:
+            host.containers.discard(container.id)
+    try:
+        container.stop(timeout=5)
+        # containers are started with remove=True, this only cleans up leftovers
+        container.remove()
+    except NotFound:
+        pass
+    except PodmanError as e:
+        logger.error(f'Could not stop container {container.id}: {e}')
 
 
 def _get_host_ports(container):
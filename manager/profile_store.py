@@ -0,0 +1,200 @@
+import ast
+import json
+import sys
+import zipfile
+from array import array
+from collections import Counter
+
+import logs
+
+# number of functions listed in the summary of a profile
+SUMMARY_TOP_FUNCTIONS = 20
+STRINGS_MEMBER = 'strings.json'
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+# node table columns, function_name, script_id and url hold indices into the string table
+NODE_COLUMNS = ['id', 'parent', 'hit_count', 'function_name', 'script_id', 'url', 'line_number', 'column_number']
+
+logger = logs.get_logger('profile_store')
+
+
+def store_profile(profile, path):
+    """
+    Stores a CDP profile (see Profiler.stop) as zip archive of typed arrays, which numpy reads as .npz file.
+
+    The node table is stored column wise (see NODE_COLUMNS), samples and timeDeltas as plain arrays.
+    :return: summary of the profile
+    """
+    strings = _StringTable()
+    columns = {name: array('q' if name == 'id' else 'i') for name in NODE_COLUMNS}
+    parents = {child: node['id'] for node in profile['nodes'] for child in node.get('children', [])}
+    for node in profile['nodes']:
+        call_frame = node['callFrame']
+        columns['id'].append(node['id'])
+        columns['parent'].append(parents.get(node['id'], -1))
+        columns['hit_count'].append(node.get('hitCount', 0))
+        columns['function_name'].append(strings.index(call_frame['functionName']))
+        columns['script_id'].append(strings.index(call_frame['scriptId']))
+        columns['url'].append(strings.index(call_frame['url']))
+        columns['line_number'].append(call_frame['lineNumber'])
+        columns['column_number'].append(call_frame['columnNumber'])
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as f:
+        for name, values in columns.items():
+            f.writestr(f'node_{name}.npy', _npy_bytes(values))
+        f.writestr('samples.npy', _npy_bytes(array('q', profile.get('samples', []))))
+        f.writestr('time_deltas.npy', _npy_bytes(array('q', profile.get('timeDeltas', []))))
+        f.writestr(STRINGS_MEMBER, json.dumps({'strings': strings.values,
+                                               'start_time': profile['startTime'],
+                                               'end_time': profile['endTime']}))
+    return summarize(profile)
+
+
+def filter_profile(profile, keep):
+    """
+    Removes the nodes of a CDP profile for which keep(call_frame) is false.
+
+    Children of removed nodes are attached to the closest remaining ancestor,
+    samples of removed nodes are dropped and their time is added to the next sample.
+    The root node is always kept.
+    """
+    nodes = profile['nodes']
+    parents = {child: node['id'] for node in nodes for child in node.get('children', [])}
+    kept = {node['id'] for node in nodes if node['id'] not in parents or keep(node['callFrame'])}
+
+    def kept_ancestor(node_id):
+        while node_id not in kept:
+            node_id = parents[node_id]
+        return node_id
+
+    children = {node_id: [] for node_id in kept}
+    for node in nodes:
+        if node['id'] in parents and node['id'] in kept:
+            children[kept_ancestor(parents[node['id']])].append(node['id'])
+    filtered_nodes = [node | {'children': children[node['id']]} for node in nodes if node['id'] in kept]
+
+    samples = []
+    time_deltas = []
+    carry = 0
+    for sample, time_delta in zip(profile.get('samples', []), profile.get('timeDeltas', [])):
+        carry += time_delta
+        if sample in kept:
+            samples.append(sample)
+            time_deltas.append(carry)
+            carry = 0
+    return profile | {'nodes': filtered_nodes, 'samples': samples, 'timeDeltas': time_deltas}
+
+
+def summarize(profile):
+    """
+    Returns the functions with the most samples (self time) and the urls of all profiled scripts.
+    """
+    samples = Counter()
+    for node in profile['nodes']:
+        call_frame = node['callFrame']
+        if node.get('hitCount') and call_frame['functionName'] not in ('(idle)', '(program)', '(root)'):
+            samples[(call_frame['functionName'], call_frame['url'], call_frame['lineNumber'])] += node['hitCount']
+    duration = profile['endTime'] - profile['startTime']
+    total_samples = len(profile.get('samples', []))
+    top_functions = [{'function_name': function_name or '(anonymous)',
+                      'url': url,
+                      'line_number': line_number,
+                      'samples': count,
+                      # the sampling interval is not part of the profile, estimate the time from the share of samples
+                      'self_time_ms': round(count / total_samples * duration / 1000, 3) if total_samples else 0}
+                     for (function_name, url, line_number), count in samples.most_common(SUMMARY_TOP_FUNCTIONS)]
+    scripts = sorted({node['callFrame']['url'] for node in profile['nodes'] if node['callFrame']['url']})
+    return {'duration_ms': duration / 1000,
+            'total_samples': total_samples,
+            'top_functions': top_functions,
+            'scripts': scripts}
+
+
+def load_profile(path):
+    """
+    Loads a stored profile as numpy arrays, numpy is only required by this function.
+    :return: dict with the node columns (node_<column>), samples, time_deltas, strings, start_time and end_time
+    """
+    import numpy as np
+
+    profile = dict()
+    with zipfile.ZipFile(path) as f:
+        for member in f.namelist():
+            if member.endswith('.npy'):
+                with f.open(member) as npy:
+                    profile[member.removesuffix('.npy')] = np.lib.format.read_array(npy)
+        profile.update(json.loads(f.read(STRINGS_MEMBER)))
+    profile['strings'] = np.array(profile['strings'], dtype=object)
+    return profile
+
+
+def load_interaction_nodes(scan_path, interaction):
+    """
+    Returns the profile nodes of an interaction, profiles of older results are stored inline.
+    :param scan_path: folder of the scan (containing result.json)
+    """
+    profile = interaction['profile']
+    if 'nodes' in profile:
+        return profile['nodes']
+    return load_nodes(scan_path / profile['file'])
+
+
+def load_nodes(path):
+    """
+    Loads the node list of a stored profile in the format of the CDP profile (without numpy).
+    """
+    with zipfile.ZipFile(path) as f:
+        columns = {name: _read_npy(f.read(f'node_{name}.npy')) for name in NODE_COLUMNS}
+        strings = json.loads(f.read(STRINGS_MEMBER))['strings']
+    nodes = []
+    node_index = dict()
+    for i, node_id in enumerate(columns['id']):
+        node = {'id': node_id,
+                'callFrame': {'functionName': strings[columns['function_name'][i]],
+                              'scriptId': strings[columns['script_id'][i]],
+                              'url': strings[columns['url'][i]],
+                              'lineNumber': columns['line_number'][i],
+                              'columnNumber': columns['column_number'][i]},
+                'hitCount': columns['hit_count'][i]}
+        node_index[node_id] = node
+        nodes.append(node)
+    for i, parent in enumerate(columns['parent']):
+        if parent != -1:
+            node_index[parent].setdefault('children', []).append(columns['id'][i])
+    return nodes
+
+
+class _StringTable:
+    def __init__(self):
+        self.values = []
+        self._indices = dict()
+
+    def index(self, value):
+        if value not in self._indices:
+            self._indices[value] = len(self.values)
+            self.values.append(value)
+        return self._indices[value]
+
+
+def _npy_bytes(values):
+    # see https://numpy.org/doc/stable/reference/generated/numpy.lib.format.html (format version 1.0)
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    header = repr({'descr': f'<i{values.itemsize}', 'fortran_order': False, 'shape': (len(values),)})
+    # the header is padded to a multiple of 64 bytes and terminated by a newline
+    padding = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = (header + ' ' * padding + '\n').encode('latin1')
+    return NPY_MAGIC + len(header).to_bytes(2, 'little') + header + values.tobytes()
+
+
+def _read_npy(data):
+    if not data.startswith(NPY_MAGIC):
+        raise ValueError('Unsupported array format.')
+    header_length = int.from_bytes(data[8:10], 'little')
+    header = ast.literal_eval(data[10:10 + header_length].decode('latin1'))
+    values = array({4: 'i', 8: 'q'}[int(header['descr'][2:])])
+    values.frombytes(data[10 + header_length:])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
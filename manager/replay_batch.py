@@ -0,0 +1,101 @@
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from podman.errors import PodmanError
+
+import logs
+from errors import ScannerError
+
+# max time in seconds a single replay may take before it is counted as failed
+REPLAY_TIMEOUT = 10 * 60
+# max time in seconds a replay that timed out may take to stop (store its result and release its container)
+STOP_TIMEOUT = 60
+
+logger = logs.get_logger('replay_batch')
+
+
+class ReplayBatch:
+    """
+    Replays a list of recorded scans with a bounded number of concurrent scanners.
+
+    :param start_replay: function starting the replay of a result id and returning its scanner
+    """
+
+    def __init__(self, result_ids, concurrency, start_replay):
+        self.id = secrets.token_hex(8)
+        # replaying a result twice at the same time would write to the same recorded scan folder
+        self.result_ids = list(dict.fromkeys(result_ids))
+        self.concurrency = concurrency
+        self._start_replay = start_replay
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'replay_batch_{self.id}')
+        self._lock = Lock()
+        self._running = set()
+        self._succeeded = []
+        self._failed = dict()
+        self._start_time = None
+        self._end_time = None
+
+    def start(self):
+        logger.info(f'Starting replay batch {self.id} ({len(self.result_ids)} results, concurrency={self.concurrency}).')
+        self._start_time = time.monotonic()
+        if not self.result_ids:
+            self._end_time = self._start_time
+        for result_id in self.result_ids:
+            self._executor.submit(self._replay, result_id)
+        self._executor.shutdown(wait=False)
+
+    def _replay(self, result_id):
+        with self._lock:
+            self._running.add(result_id)
+        try:
+            scanner = self._start_replay(result_id)
+            if scanner.completed.wait(timeout=REPLAY_TIMEOUT):
+                error = scanner.error
+            else:
+                error = f'Replay did not complete within {REPLAY_TIMEOUT} seconds.'
+                # the scanner holds an admission slot and a container, the next replay only starts once it stopped
+                scanner.stop(error)
+                if not scanner.completed.wait(timeout=STOP_TIMEOUT):
+                    logger.error(f'Replay of {result_id} did not stop within {STOP_TIMEOUT} seconds.')
+        except (ScannerError, PodmanError) as e:
+            error = str(e)
+        except Exception as e:
+            logger.error(f'Replay of {result_id} failed: {e}', exc_info=e)
+            error = str(e)
+
+        with self._lock:
+            self._running.discard(result_id)
+            if error is None:
+                self._succeeded.append(result_id)
+            else:
+                logger.warning(f'Replay of {result_id} failed: {error}')
+                self._failed[result_id] = error
+            if len(self._succeeded) + len(self._failed) == len(self.result_ids):
+                self._end_time = time.monotonic()
+                logger.info(f'Replay batch {self.id} complete. ({len(self._failed)} failed)')
+
+    def end_time(self):
+        """
+        Returns time.monotonic() of the completion of the batch, None while replays are pending or running.
+        """
+        with self._lock:
+            return self._end_time
+
+    def status(self):
+        with self._lock:
+            finished = len(self._succeeded) + len(self._failed)
+            end_time = self._end_time or time.monotonic()
+            elapsed = end_time - self._start_time if self._start_time else 0
+            return {'batch_id': self.id,
+                    'total': len(self.result_ids),
+                    'pending': len(self.result_ids) - finished - len(self._running),
+                    'running': sorted(self._running),
+                    'succeeded': len(self._succeeded),
+                    'failed': len(self._failed),
+                    'failures': self._failed.copy(),
+                    'complete': self._end_time is not None,
+                    'elapsed_seconds': round(elapsed, 1),
+                    # finished replays per minute
+                    'throughput': round(finished / elapsed * 60, 2) if elapsed else 0}
@@ -1,10 +1,18 @@
 import json
-import shutil
+import os
+import secrets
+import sqlite3
+import time
 from datetime import datetime
 from pathlib import Path
 
+import catalog
+import compression
+import config
 import logs
+import result_io
 import utils
+import zip_stream
 from errors import ScannerInitError, ScannerError
 from utils import DirectoryFileHandler
 
@@ -21,11 +29,17 @@ class ResultKey:
 
     # interaction entries
     SITE_URL = 'site url'
+    # ScannerOptions of the run
+    OPTIONS = 'scanner options'
     URL = 'url'
     EVENT = 'event'
     TIMESTAMP = 'timestamp'
     SCREENSHOTS = 'screenshots'
     USER_INTERACTION = 'user interaction'
+    EXTRACTOR_TIMES = 'extractor times'
+    # extractor name -> error of extractors that timed out (or depend on one that did)
+    EXTRACTOR_ERRORS = 'extractor errors'
+    HAR = 'har'
     ERROR = 'error'
 
 
@@ -37,6 +51,11 @@ RECORDED_SCAN_PREFIX = 'recorded_scan_'
 RESULT_FILENAME = 'result.json'
 RESULT_PATH = Path('results')
 DOWNLOAD_PATH = Path('download')
+# bytes of cached archives kept in DOWNLOAD_PATH, the least recently used archives are removed first
+ARCHIVE_CACHE_SIZE = config.storage.getint('archive_cache_size', fallback=1024) * 1024 * 1024
+EXPORT_MANIFEST = 'manifest.json'
+# catalog entries of the exported scans listed in the manifest
+EXPORT_SCAN_KEYS = {'id', 'site_url', 'created', 'updated', 'success', 'replay_count', 'seq'}
 
 logger = logs.get_logger('results')
 
@@ -44,17 +63,25 @@ logger = logs.get_logger('results')
 class Result:
     """
     see https://github.com/PrivacyScore/privacyscanner/blob/master/privacyscanner/result.py
+
+    While the scan runs, updates are appended to a journal (see store_updates and add_interaction).
+    store_result compacts the journal into result.json.
+    Interactions are only kept in the journal, the memory used by a scan does not grow with its interactions.
     """
 
     def __init__(self, result_dict, result_id, initial_scan):
-        self._result_dict = result_dict
+        # interactions are added by add_interaction
+        self._result_dict = {key: value for key, value in result_dict.items() if key != ResultKey.INTERACTION}
         self.result_id = result_id
         self._result_path = (RESULT_PATH / result_id).resolve()
         self._current_scan_path = self.get_current_scan_path(initial_scan)
         self._file_handler = DirectoryFileHandler(self._current_scan_path)
-        self._updated_keys = set()
+        self._updated_keys = set(self._result_dict)
+        self._compacted = False
+        self._started = time.time()
         self.num_screenshots = 0
-        self.store_result()
+        self.store_updates()
+        self._update_catalog()
 
     def get_current_scan_path(self, initial_scan):
         if initial_scan and self._result_path.exists():
@@ -138,16 +165,113 @@ class Result:
     def get_results(self):
         return self._result_dict
 
+    def add_interaction(self, interaction):
+        """
+        Appends an interaction to the journal, entries that are only iterable (e.g. lazily read records)
+        are written one by one (see result_io.append_journal).
+        """
+        self._append_journal({'interaction': interaction})
+        if self._compacted:
+            self.store_result()
+
+    def store_updates(self):
+        """
+        Appends the keys updated since the last call to the journal (interactions are added by add_interaction).
+        """
+        if self._compacted:
+            self.store_result()
+            return
+        updates = self.get_updates()
+        self._updated_keys.clear()
+        if updates:
+            self._append_journal({'set': updates})
+
+    def _append_journal(self, record):
+        try:
+            result_io.append_journal(self._current_scan_path / result_io.JOURNAL_FILENAME, record)
+        except IOError as e:
+            raise ScannerInitError("Could not write result journal: {}".format(e)) from e
+
     def store_result(self, note=None):
+        """
+        Compacts the journal: writes result.json atomically and removes the journal.
+        Interactions are streamed from the journal, they are stored in the configured encoding
+        (see result_io.INTERACTION_ENCODING), the file is compressed with the configured codec (see compression.COMPRESSION).
+        """
         if note:
             self['user_note'] = note
-        result_file = self._current_scan_path / RESULT_FILENAME
+        self._updated_keys.clear()
         try:
-            with result_file.open("w") as f:
-                json.dump(self._result_dict, f, indent=2, sort_keys=True)
-                f.write("\n")
-        except IOError as e:
+            _write_result(self._current_scan_path, self._result_dict, self._stored_interactions())
+        except (IOError, ValueError) as e:
             raise ScannerInitError("Could not write result JSON: {}".format(e)) from e
+        self._compacted = True
+        self._update_catalog(finished=time.time())
+
+    def _stored_interactions(self):
+        if self._compacted:
+            # updates after the scan completed (rare), the compacted interactions are read back
+            yield from load_result(self._current_scan_path)[ResultKey.INTERACTION]
+        journal = self._current_scan_path / result_io.JOURNAL_FILENAME
+        if journal.exists():
+            yield from result_io.journal_interactions(journal)
+
+    def _update_catalog(self, finished=None):
+        _update_catalog(self._current_scan_path, self._result_dict, self._started, finished)
+
+
+def _update_catalog(scan_path, result_dict, started, finished=None):
+    try:
+        catalog.record_run(scan_path.parent.name, scan_path.name, result_dict.get(ResultKey.SITE_URL), started, finished,
+                           ResultKey.ERROR not in result_dict, _folder_size(scan_path), scan_path.name == FIRST_SCAN)
+    except sqlite3.Error as e:
+        # the catalog can be rebuilt from the result folders
+        logger.error(f'Could not update catalog: {e}')
+
+
+def _write_result(scan_path, result_dict, interactions):
+    """
+    Writes result.json of a scan atomically and removes its journal.
+    :param interactions: iterable of the interactions, e.g. streamed from the journal
+    """
+    result_file = compression.compressed_path(scan_path / RESULT_FILENAME)
+    tmp_file = result_file.with_name(result_file.name + '.tmp')
+    try:
+        with compression.open_write(tmp_file) as f:
+            result_io.dump_result(f, result_dict, interactions)
+        # the compressed stream is complete once the file is closed
+        with tmp_file.open('rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_file, result_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    # result.json takes precedence over the journal, a crash before the removal loses nothing
+    (scan_path / result_io.JOURNAL_FILENAME).unlink(missing_ok=True)
+
+
+def recover_journals():
+    """
+    Compacts the journals left behind by terminated scanners (e.g. a crash or restart of the manager),
+    their runs are recorded as finished with an error.
+    Must not run while scans are active, their journals would be compacted as well.
+    """
+    for journal in RESULT_PATH.glob(f'*/*/{result_io.JOURNAL_FILENAME}'):
+        scan_path = journal.parent
+        if compression.find(scan_path / RESULT_FILENAME):
+            # terminated after the compaction, result.json takes precedence
+            journal.unlink(missing_ok=True)
+            continue
+        try:
+            result_dict = result_io.read_updates(journal)
+            result_dict.setdefault(ResultKey.ERROR, 'Scanner terminated before the scan was stored.')
+            first = next(result_io.journal_interactions(journal), None)
+            started = first[ResultKey.TIMESTAMP] if first else journal.stat().st_mtime
+            _write_result(scan_path, result_dict, result_io.journal_interactions(journal))
+        except (OSError, ValueError) as e:
+            logger.error(f'Could not recover journal {journal}: {e}')
+            continue
+        _update_catalog(scan_path, result_dict, started, finished=time.time())
+        logger.info(f'Recovered journal of {scan_path}.')
 
 
 def get_scan_info(result_id):
@@ -156,13 +280,30 @@ def get_scan_info(result_id):
     :param result_id: result id referencing the result root folder
     :return: result json containing urls, events and user interaction of the first scan
     """
+    if not catalog.scan_exists(result_id):
+        raise ScannerError(f"Result {result_id} does not exist.")
     result_path = (Path("results") / result_id / FIRST_SCAN / RESULT_FILENAME).resolve()
-    if not result_path.exists() or result_path.is_dir():
+    if not (compression.find(result_path) or result_path.with_name(result_io.JOURNAL_FILENAME).is_file()):
         raise ScannerError(f"Result file {str(result_path)} does not exist.")
-    with open(result_path) as f:
-        first_result = json.load(f)
-        interaction_filtered = list(map(filter_entry, first_result[ResultKey.INTERACTION]))
-        return {ResultKey.SITE_URL: first_result[ResultKey.SITE_URL], ResultKey.INTERACTION: interaction_filtered}
+    first_result = load_result(result_path.parent)
+    interaction_filtered = list(map(filter_entry, first_result[ResultKey.INTERACTION]))
+    return {ResultKey.SITE_URL: first_result[ResultKey.SITE_URL], ResultKey.INTERACTION: interaction_filtered}
+
+
+def load_result(scan_path):
+    """
+    Returns the result of a scan, interactions are full snapshots independent of the stored encoding.
+    :param scan_path: folder of the scan (first scan or recorded scan)
+    """
+    return result_io.load_result(scan_path / RESULT_FILENAME)
+
+
+def get_result_ids():
+    """
+    Returns the ids of all results with a first scan, i.e. all results that can be replayed.
+    """
+    scans, _total = catalog.get_scans(replayable=True)
+    return sorted(scan['id'] for scan in scans)
 
 
 def filter_entry(e):
@@ -172,55 +313,186 @@ def filter_entry(e):
     return filter_dict(e, interaction_filter)
 
 
-def get_all_scans():
+def get_all_scans(limit=None, offset=0, site=None, success=None):
+    """
+    Returns the scans listed in the catalog (newest first), see catalog.get_scans for the filters.
+    :return: list of scans and the total number of scans matching the filters
+    """
     scans = []
-    for p in RESULT_PATH.iterdir():
-        current_scan = {'id': p.name, 'replays': []}
-        if not p.is_dir():
-            # .gitignore file
-            continue
-        for scan in p.iterdir():
-            if not scan.is_dir():
-                # e.g. result zip files
-                continue
-            logger.debug(scan)
-            success = scan_successful(scan)
-            if scan.name == FIRST_SCAN:
-                current_scan['initial'] = {'success': success}
+    entries, total = catalog.get_scans(limit, offset, site, success)
+    for entry in entries:
+        current_scan = {'id': entry['id'],
+                        'site_url': entry['site_url'],
+                        'created': entry['created'],
+                        'updated': entry['updated'],
+                        'replay_count': entry['replay_count'],
+                        'size': entry['size'],
+                        'replays': []}
+        for run in entry['runs']:
+            run_info = {'success': bool(run['success']), 'finished': run['finished'], 'size': run['size']}
+            if run['name'] == FIRST_SCAN:
+                current_scan['initial'] = run_info
             else:
-                current_scan['replays'].append({'success': success})
+                current_scan['replays'].append(run_info)
         scans.append(current_scan)
-    return scans
+    return scans, total
+
+
+def rebuild_catalog():
+    """
+    Replaces the catalog with the scans found in the result folders (see catalog.replace).
+    :return: number of indexed scans
+    """
+    start = time.time()
+    runs = []
+    for result_path in RESULT_PATH.iterdir():
+        if not result_path.is_dir():
+            # .gitkeep file
+            continue
+        for run_path in sorted(p for p in result_path.iterdir() if p.is_dir()):
+            try:
+                r = load_result(run_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f'Skipping {run_path}: {e}')
+                continue
+            interaction = r.get(ResultKey.INTERACTION, [])
+            started = interaction[0][ResultKey.TIMESTAMP] if interaction else run_path.stat().st_mtime
+            # runs are compacted once they are finished (see Result.store_result)
+            finished = run_path.stat().st_mtime if compression.find(run_path / RESULT_FILENAME) else None
+            runs.append({'scan_id': result_path.name,
+                         'run_name': run_path.name,
+                         'site_url': r.get(ResultKey.SITE_URL),
+                         'started': started,
+                         'finished': finished,
+                         'success': ResultKey.ERROR not in r,
+                         'size': _folder_size(run_path),
+                         'first_scan': run_path.name == FIRST_SCAN})
+    return catalog.replace(runs, start)
+
+
+def cached_archive(scan_id):
+    """
+    Returns the path of the cached archive of a scan, None if the current version of the scan is not cached.
+    """
+    version = _archive_version(scan_id)
+    if version is None:
+        return None
+    path = DOWNLOAD_PATH / f'{scan_id}.{version}.zip'
+    try:
+        # mark the archive as recently used (see _evict_archives)
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
 
 
-def archive_result(scan_id):
+def stream_result(scan_id):
+    """
+    Returns the ZIP archive of a scan as chunks, the archive is cached while it is streamed (see cached_archive)
+    unless a run of the scan is active.
+    :raises ScannerError: if scan_id is not a scan id
+    """
     if not is_scan_id(scan_id):
         # prevent path traversal
         raise ScannerError(f'Download failed, {scan_id} is not a scan id.')
-    # store result inside folder
-    shutil.make_archive(DOWNLOAD_PATH / scan_id, 'zip', RESULT_PATH / scan_id)
-    return f'{scan_id}.zip'
+    chunks = zip_stream.stream_zip(RESULT_PATH / scan_id)
+    version = _archive_version(scan_id)
+    if version is None or ARCHIVE_CACHE_SIZE <= 0:
+        return chunks
+    return _cache_archive(chunks, scan_id, version)
 
 
-def archive_all_results():
+def stream_all_results():
+    """
+    Returns the file name and the chunks of a ZIP archive of all results.
+    """
     time_str = datetime.now().strftime("%d-%m-%Y_%H-%M")
-    filename = 'results_' + time_str
-    shutil.make_archive(DOWNLOAD_PATH / filename, "zip", RESULT_PATH)
-    return filename + '.zip'
+    return f'results_{time_str}.zip', zip_stream.stream_zip(RESULT_PATH)
+
+
+def export_results(after_cursor=None, updated_after=None):
+    """
+    Returns the file name and the chunks of a ZIP archive of the scans changed after the cursor.
+    The archive ends with EXPORT_MANIFEST, containing the exported scans, the SHA-256 digest of every exported file
+    and the cursor (catalog seq) to pass as after_cursor to the next export.
+    :param after_cursor: cursor of the previous export, None exports all scans (unless updated_after is given)
+    :param updated_after: unix timestamp, alternative to after_cursor
+    """
+    # read before listing, scans changed during the export are exported again next time
+    cursor = catalog.current_seq()
+    scans, _total = catalog.get_scans(since=after_cursor, updated_after=updated_after)
+    files = ((path, path.relative_to(RESULT_PATH))
+             for scan in scans for path in sorted((RESULT_PATH / scan['id']).rglob('*')))
+    digests = dict()
+
+    def manifest():
+        return EXPORT_MANIFEST, json.dumps({'after_cursor': after_cursor,
+                                            'updated_after': updated_after,
+                                            'cursor': cursor,
+                                            'scans': [filter_dict(scan, EXPORT_SCAN_KEYS) for scan in scans],
+                                            'files': digests}, indent=2, sort_keys=True)
+
+    return f'export_{cursor}.zip', zip_stream.stream_files(files, digests, manifest)
+
+
+def _archive_version(scan_id):
+    # the catalog seq changes with every run, active runs change their files without changing the seq
+    scan = catalog.get_scan(scan_id)
+    if scan is None or scan['active_runs']:
+        return None
+    return scan['seq']
+
+
+def _cache_archive(chunks, scan_id, version):
+    path = DOWNLOAD_PATH / f'{scan_id}.{version}.zip'
+    # concurrent downloads of the same scan write their own file
+    tmp_path = path.with_name(f'{path.name}.{secrets.token_hex(4)}.tmp')
+    try:
+        with tmp_path.open('wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        tmp_path.replace(path)
+    finally:
+        # the download was aborted
+        tmp_path.unlink(missing_ok=True)
+    # a concurrent download may already have cached a newer version
+    for cached in DOWNLOAD_PATH.glob(f'{scan_id}.*.zip'):
+        cached_version = cached.name[len(scan_id) + 1:-len('.zip')]
+        if cached_version.isdigit() and int(cached_version) < version:
+            cached.unlink(missing_ok=True)
+    _evict_archives()
+
+
+def _evict_archives():
+    # removes the least recently used archives (see cached_archive) until the cache fits ARCHIVE_CACHE_SIZE
+    archives = []
+    for path in DOWNLOAD_PATH.glob('*.zip'):
+        try:
+            archives.append((path.stat(), path))
+        except FileNotFoundError:
+            # evicted by a concurrent download
+            continue
+    size = sum(stat.st_size for stat, _path in archives)
+    for stat, path in sorted(archives, key=lambda archive: archive[0].st_mtime):
+        if size <= ARCHIVE_CACHE_SIZE:
+            break
+        path.unlink(missing_ok=True)
+        size -= stat.st_size
+        logger.debug(f'Evicted cached archive {path.name}.')
 
 
 def is_scan_id(scan_id):
-    scan_path = RESULT_PATH
-    for s in scan_path.iterdir():
-        if s.name == scan_id:
-            return True
-    return False
+    return catalog.scan_exists(scan_id)
 
 
 def scan_successful(path):
-    with open(path / RESULT_FILENAME) as f:
-        r = json.load(f)
-        return not (ResultKey.ERROR in r)
+    r = load_result(path)
+    return not (ResultKey.ERROR in r)
+
+
+def _folder_size(path):
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
 
 
 def filter_dict(d, keys):
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import compression
+import config
+import utils
+
+# storage of the interactions in result.json:
+# full (every interaction is a snapshot) or delta (later interactions only store the changes to the previous one)
+INTERACTION_ENCODING = config.storage.get('interaction_encoding', fallback='full')
+
+# result keys (see result.ResultKey), result.py depends on this module
+INTERACTION = 'interaction'
+TIMESTAMP = 'timestamp'
+ENCODING = 'interaction encoding'
+
+# journal of a running scan, replaced by result.json once the scan completed
+JOURNAL_FILENAME = 'result.journal.jsonl'
+
+
+def _cookie_identity(cookie):
+    # utils imports this module, the function is therefore looked up on use
+    return utils.cookie_identity(cookie)
+
+
+def _record_identity(record):
+    # requests and responses have no id, identical records are the same entry
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest(),
+
+
+# delta encoded interaction entries and the identity of their elements
+DELTA_KEYS = {'cookies': _cookie_identity,
+              'fp_cookies': _cookie_identity,
+              'requests': _record_identity,
+              'failed_requests': _record_identity,
+              'responses': _record_identity}
+COOKIE_KEYS = {'cookies', 'fp_cookies'}
+
+
+def encode_result(result_dict, encoding=None):
+    """
+    Returns the result in the given interaction encoding (defaults to INTERACTION_ENCODING).
+
+    A delta encoded interaction stores every entry of DELTA_KEYS as the elements removed from, changed in
+    and added to the entry of the previous interaction (and their order, if it differs).
+    Removed and changed elements are referenced by their identity (including their occurrence).
+    The cookie lifetime is derived from the interaction timestamp and therefore not compared.
+    """
+    encoding = encoding or INTERACTION_ENCODING
+    if encoding == 'full':
+        return result_dict
+    encoded = list(encode_interactions(result_dict.get(INTERACTION, []), encoding))
+    return result_dict | {ENCODING: 'delta', INTERACTION: encoded}
+
+
+def encode_interactions(interactions, encoding=None):
+    """
+    Yields the interactions in the given interaction encoding one by one (see encode_result).
+    Only the previous interaction is kept, the interactions can therefore be streamed (e.g. from the journal).
+    """
+    encoding = encoding or INTERACTION_ENCODING
+    if encoding not in ('full', 'delta'):
+        raise ValueError(f'Unknown interaction encoding {encoding}.')
+    previous = None
+    for interaction in interactions:
+        if encoding == 'full' or previous is None:
+            yield interaction
+        else:
+            yield interaction | {key: _encode_entry(key, previous[key], interaction[key])
+                                 for key in DELTA_KEYS if key in previous and key in interaction}
+        previous = interaction
+
+
+def dump_result(f, result_dict, interactions, encoding=None):
+    """
+    Writes result.json to f, the interactions are encoded (see encode_interactions) and written one by one.
+    :param result_dict: result without interactions
+    :param interactions: iterable of the interactions as full snapshots
+    """
+    encoding = encoding or INTERACTION_ENCODING
+    header = {key: value for key, value in result_dict.items() if key != INTERACTION}
+    if encoding != 'full':
+        header[ENCODING] = encoding
+    f.write('{')
+    for i, key in enumerate(sorted([*header, INTERACTION])):
+        f.write(',\n  ' if i else '\n  ')
+        f.write(json.dumps(key) + ': ')
+        if key != INTERACTION:
+            f.write(json.dumps(header[key], sort_keys=True))
+            continue
+        f.write('[')
+        for j, interaction in enumerate(encode_interactions(interactions, encoding)):
+            f.write(',\n    ' if j else '\n    ')
+            f.write(json.dumps(interaction, sort_keys=True))
+        f.write('\n  ]')
+    f.write('\n}\n')
+
+
+def decode_result(result_dict):
+    """
+    Returns the result with every interaction as full snapshot (see encode_result).
+    """
+    if result_dict.get(ENCODING, 'full') == 'full':
+        return result_dict
+    interactions = result_dict[INTERACTION]
+    decoded = [interactions[0]] if interactions else []
+    for interaction in interactions[1:]:
+        previous = decoded[-1]
+        decoded.append(interaction | {key: _decode_entry(key, previous[key], interaction[key], interaction[TIMESTAMP])
+                                      for key in DELTA_KEYS if key in previous and key in interaction})
+    result_dict = result_dict | {INTERACTION: decoded}
+    del result_dict[ENCODING]
+    return result_dict
+
+
+def load_result(path):
+    """
+    Reads a result.json file (compressed or not), interactions are returned as full snapshots independent of
+    their encoding. The journal next to the file is read instead, if the scan was not compacted yet (see result.Result).
+    """
+    path = Path(path)
+    stored = compression.find(path)
+    if stored is None:
+        return read_journal(path.with_name(JOURNAL_FILENAME))
+    return decode_result(compression.load_json(stored))
+
+
+def append_journal(path, record):
+    """
+    Appends a record to a journal, the record is synced to disk before returning.
+    Values that are only iterable (e.g. capture_buffer.Records) are written element by element.
+    """
+    with open(path, 'a') as f:
+        _write_json(f, record)
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_json(f, value):
+    if isinstance(value, dict):
+        f.write('{')
+        for i, (key, item) in enumerate(value.items()):
+            f.write(f'{", " if i else ""}{json.dumps(key)}: ')
+            _write_json(f, item)
+        f.write('}')
+    elif isinstance(value, (str, list, tuple)) or not hasattr(value, '__iter__'):
+        f.write(json.dumps(value))
+    else:
+        f.write('[')
+        for i, element in enumerate(value):
+            f.write(f'{", " if i else ""}{json.dumps(element)}')
+        f.write(']')
+
+
+def read_journal(path):
+    """
+    Returns the result recorded in a journal.
+    The journal consists of "set" records (updated keys of the result) and "interaction" records (one per interaction).
+    """
+    result_dict = {INTERACTION: []}
+    for record in iter_journal(path):
+        if 'set' in record:
+            result_dict.update(record['set'])
+        else:
+            result_dict[INTERACTION].append(record['interaction'])
+    return result_dict
+
+
+def read_updates(path):
+    """
+    Returns the keys set in a journal, its interactions are skipped (see read_journal).
+    """
+    result_dict = dict()
+    for record in iter_journal(path):
+        if 'set' in record:
+            result_dict.update(record['set'])
+    return result_dict
+
+
+def iter_journal(path):
+    """
+    Yields the records of a journal one by one (see read_journal).
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last record of a crashed scanner
+                return
+            yield record
+
+
+def journal_interactions(path):
+    """
+    Yields the interactions recorded in a journal one by one.
+    """
+    for record in iter_journal(path):
+        if 'interaction' in record:
+            yield record['interaction']
+
+
+def _identities(key, elements):
+    # duplicates are distinguished by their occurrence
+    identity = DELTA_KEYS[key]
+    occurrences = dict()
+    identities = []
+    for element in elements:
+        element_identity = identity(element)
+        occurrences[element_identity] = occurrences.get(element_identity, -1) + 1
+        identities.append(element_identity + (occurrences[element_identity],))
+    return identities
+
+
+def _comparable(key, element):
+    if key in COOKIE_KEYS:
+        return {k: v for k, v in element.items() if k != 'lifetime'}
+    return element
+
+
+def _encode_entry(key, previous, current):
+    previous_elements = dict(zip(_identities(key, previous), previous))
+    current_identities = _identities(key, current)
+    current_elements = dict(zip(current_identities, current))
+    removed = [identity for identity in previous_elements if identity not in current_elements]
+    changed = [[identity, _comparable(key, element)] for identity, element in current_elements.items()
+               if identity in previous_elements
+               and _comparable(key, previous_elements[identity]) != _comparable(key, element)]
+    added = [_comparable(key, element) for identity, element in current_elements.items()
+             if identity not in previous_elements]
+    delta = {'removed': removed, 'changed': changed, 'added': added}
+
+    # order of the decoded entry: remaining previous elements followed by the added elements
+    decoded_order = [identity for identity in previous_elements if identity in current_elements] + \
+                    [identity for identity in current_identities if identity not in previous_elements]
+    if decoded_order != current_identities:
+        positions = {identity: i for i, identity in enumerate(decoded_order)}
+        delta['order'] = [positions[identity] for identity in current_identities]
+    return delta
+
+
+def _decode_entry(key, previous, delta, timestamp):
+    removed = {tuple(identity) for identity in delta['removed']}
+    # elements keep their identity when they change (only cookies change, other elements are identified by content)
+    changed = {tuple(identity): element for identity, element in delta['changed']}
+    decoded = [changed.get(identity, element) for identity, element in zip(_identities(key, previous), previous)
+               if identity not in removed] + delta['added']
+    if 'order' in delta:
+        decoded = [decoded[i] for i in delta['order']]
+    if key in COOKIE_KEYS:
+        decoded = [_with_lifetime(cookie, timestamp) for cookie in decoded]
+    return decoded
+
+
+def _with_lifetime(cookie, timestamp):
+    # see extractors.cookies.calc_lifetime
+    lifetime = -1 if cookie['expires'] is None else cookie['expires'] - timestamp
+    return cookie | {'lifetime': lifetime}
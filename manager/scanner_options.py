@@ -0,0 +1,74 @@
+from extractors import EXTRACTOR_CLASSES
+from errors import ScannerInitError
+
+# default profiler sampling interval in microseconds (2 kHz)
+DEFAULT_SAMPLING_INTERVAL = 500
+# bounds of the sampling interval, chrome does not sample faster than every 50 microseconds
+MIN_SAMPLING_INTERVAL = 50
+MAX_SAMPLING_INTERVAL = 1000 * 1000
+
+EXTRACTOR_NAMES = [extractor_class.name for extractor_class in EXTRACTOR_CLASSES]
+
+
+class ScannerOptions:
+    """
+    Per scan configuration of the scanner.
+
+    :param extractors: names of the extractors to run (see EXTRACTOR_NAMES), defaults to all extractors
+    :param sampling_interval: profiler sampling interval in microseconds
+    :param profile_third_party_only: only store profile nodes of third party scripts
+    """
+
+    def __init__(self, extractors=None, sampling_interval=DEFAULT_SAMPLING_INTERVAL, profile_third_party_only=False):
+        self.extractors = list(EXTRACTOR_NAMES if extractors is None else extractors)
+        self.sampling_interval = sampling_interval
+        self.profile_third_party_only = profile_third_party_only
+
+    @classmethod
+    def from_json(cls, options_json):
+        """
+        Parses the options of a scan request, missing options keep their default.
+        :raises ScannerInitError: if the options are invalid
+        """
+        if options_json is None:
+            return cls()
+        if not isinstance(options_json, dict):
+            raise ScannerInitError('Options must be a JSON object.')
+        unknown = set(options_json) - {'extractors', 'sampling_interval', 'profile_third_party_only'}
+        if unknown:
+            raise ScannerInitError(f'Unknown options: {", ".join(sorted(unknown))}.')
+
+        extractors = options_json.get('extractors', EXTRACTOR_NAMES)
+        if not isinstance(extractors, list) or not all(isinstance(e, str) for e in extractors):
+            raise ScannerInitError('Option extractors must be a list of extractor names.')
+        unknown = set(extractors) - set(EXTRACTOR_NAMES)
+        if unknown:
+            raise ScannerInitError(f'Unknown extractors: {", ".join(sorted(unknown))} '
+                                   f'(available: {", ".join(EXTRACTOR_NAMES)}).')
+
+        sampling_interval = options_json.get('sampling_interval', DEFAULT_SAMPLING_INTERVAL)
+        # bool is a subclass of int
+        if not isinstance(sampling_interval, int) or isinstance(sampling_interval, bool) or \
+                not MIN_SAMPLING_INTERVAL <= sampling_interval <= MAX_SAMPLING_INTERVAL:
+            raise ScannerInitError(f'Option sampling_interval must be an integer between {MIN_SAMPLING_INTERVAL} '
+                                   f'and {MAX_SAMPLING_INTERVAL} (microseconds).')
+
+        profile_third_party_only = options_json.get('profile_third_party_only', False)
+        if not isinstance(profile_third_party_only, bool):
+            raise ScannerInitError('Option profile_third_party_only must be a boolean.')
+
+        return cls(extractors, sampling_interval, profile_third_party_only)
+
+    def to_json(self):
+        """
+        Returns the options in the format of from_json, e.g. to store them with the result.
+        """
+        return {'extractors': list(self.extractors),
+                'sampling_interval': self.sampling_interval,
+                'profile_third_party_only': self.profile_third_party_only}
+
+    def extractor_classes(self):
+        return [c for c in EXTRACTOR_CLASSES if c.name in self.extractors]
+
+    def extractor_enabled(self, name):
+        return name in self.extractors
@@ -0,0 +1,55 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import logs
+
+# threads for blocking calls of the scanners (asyncio.to_thread), e.g. podman requests and file writes
+RUNTIME_WORKERS = 32
+
+logger = logs.get_logger('scanner_runtime')
+
+_runtime = None
+_runtime_lock = Lock()
+
+
+class ScannerRuntime:
+    """
+    Runs all scanners as tasks of a single event loop, which is driven by a dedicated daemon thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=RUNTIME_WORKERS,
+                                                          thread_name_prefix='scanner_runtime_io'))
+        self._thread = Thread(target=self._run, name='scanner_runtime', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        logger.info('Scanner runtime started.')
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """
+        Schedules a coroutine on the event loop (thread-safe).
+        :return: concurrent.futures.Future of the coroutine result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules a callback on the event loop (thread-safe).
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+
+def get_runtime():
+    """
+    Returns the scanner runtime, it is started on first use.
+    """
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = ScannerRuntime()
+        return _runtime
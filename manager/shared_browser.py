@@ -0,0 +1,138 @@
+import secrets
+from threading import Event, Lock
+
+from podman.errors import PodmanError
+
+import logs
+import podman_container
+
+logger = logs.get_logger('shared_browser')
+
+
+class ContextLease:
+    """
+    A browser context slot inside a shared container.
+
+    Scanners use a lease in place of a container: they connect to the same devtools endpoint,
+    but create their own browser context (HAR file, cookie jar and CDP session).
+    """
+
+    def __init__(self, shared_browser, container, slot):
+        self.id = f'{container.id}-{slot}'
+        # slot reserved in the shared container
+        self.slot = slot
+        self.container = container
+        self.address = container.address
+        self.devtools_port = container.devtools_port
+        self.ready_time = container.ready_time
+        # the screen of a shared container is not handed out
+        self.vnc_port = None
+        self._shared_browser = shared_browser
+
+    def release(self):
+        self._shared_browser.release(self)
+
+
+class SharedContainer:
+    def __init__(self):
+        # None while the container is starting
+        self.container = None
+        # reserved slots
+        self.leases = set()
+        # set once the container is running or could not be started (error)
+        self.started = Event()
+        self.error = None
+
+
+class SharedBrowser:
+    """
+    Hosts several concurrent browser contexts in long-lived containers, for scans that need no VNC screen.
+    A context limit of 0 disables the shared mode.
+    """
+
+    def __init__(self, max_contexts, profile):
+        self.max_contexts = max_contexts
+        self.profile = profile
+        self._containers = []
+        self._lock = Lock()
+
+    def enabled(self):
+        return self.max_contexts > 0
+
+    def lease(self):
+        """
+        Returns a context lease in a shared container, a new container is started if all are fully used.
+        :raises PodmanError: if no container could be started
+        """
+        self._drop_stopped()
+        slot = secrets.token_hex(4)
+        # reserve a slot under the lock, containers are started outside of it (this takes up to 30 seconds)
+        with self._lock:
+            shared = next((s for s in self._containers if len(s.leases) < self.max_contexts), None)
+            start = shared is None
+            if start:
+                shared = SharedContainer()
+                self._containers.append(shared)
+            shared.leases.add(slot)
+
+        if start:
+            try:
+                container = podman_container.run_container(self.profile, long_lived=True)
+                logger.info(f'Started shared browser container (container id={container.id}).')
+                with self._lock:
+                    shared.container = container
+            except Exception as e:
+                with self._lock:
+                    if shared in self._containers:
+                        self._containers.remove(shared)
+                shared.error = e
+                raise
+            finally:
+                shared.started.set()
+        else:
+            shared.started.wait()
+            if shared.error is not None:
+                raise PodmanError(f'Shared browser container could not be started: {shared.error}')
+        lease = ContextLease(self, shared.container, slot)
+        logger.info(f'Leased browser context {lease.id} ({len(shared.leases)}/{self.max_contexts} in use).')
+        return lease
+
+    def release(self, lease):
+        with self._lock:
+            shared = next((s for s in self._containers if s.container is lease.container), None)
+            if shared is None:
+                return
+            shared.leases.discard(lease.slot)
+            # keep one container running, stop surplus containers once they are unused
+            surplus = [s for s in self._containers if not s.leases][1:]
+            for s in surplus:
+                self._containers.remove(s)
+        for s in surplus:
+            self._stop(s)
+
+    def shutdown(self):
+        with self._lock:
+            containers = list(self._containers)
+            self._containers.clear()
+        for s in containers:
+            # containers which are still starting are stopped once they run
+            s.started.wait(podman_container.DEVTOOLS_READY_TIMEOUT)
+            if s.container is not None:
+                self._stop(s)
+
+    def _drop_stopped(self):
+        with self._lock:
+            running = [s for s in self._containers if s.started.is_set()]
+        # podman is queried outside of the lock
+        stopped = [s for s in running if not podman_container.is_running(s.container.id)]
+        with self._lock:
+            for s in stopped:
+                if s in self._containers:
+                    logger.warning(f'Shared browser container {s.container.id} stopped unexpectedly.')
+                    self._containers.remove(s)
+
+    def _stop(self, shared):
+        try:
+            podman_container.stop_container(shared.container.id)
+        except PodmanError as e:
+            logger.warning(f'Could not stop shared browser container {shared.container.id}: {e}')
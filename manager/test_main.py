@@ -1,6 +1,5 @@
 import asyncio
 import csv
-import json
 from collections import defaultdict
 from pathlib import Path
 from urllib.parse import urlparse
@@ -137,28 +136,26 @@ def analyze():
             print(f'{result_folder.name} skipped.')
             continue
         print(f'{i}) {result_folder.name}:')
-        first_result_json_path = result_folder / result.FIRST_SCAN / result.RESULT_FILENAME
-        with open(first_result_json_path) as f:
-            r = json.load(f)
-
-            scan_domain = str(urlparse(r[result.ResultKey.SITE_URL]).netloc)
-            # cut off www
-            if scan_domain.startswith('www.'):
-                scan_domain = scan_domain[len('www.'):]
-
-            interaction = r[result.ResultKey.INTERACTION]
-            if len(interaction) != 2:
-                print(f'{result_folder.name} skipped. (unexpected number of interactions: {len(interaction)})')
-                continue
-            analysis_filename = (result_folder / result.FIRST_SCAN)
-            results = analyze_interaction(scan_domain, interaction[0], interaction[1], analysis_filename)
-
-            append_count(results['tp_requests_before'], tp_count_before)
-            append_count(results['tp_requests_additional'], tp_count_additional)
-            append_count(results['tp_requests_total'], tp_count_total)
-            append_count(results['tracking_tp_before'], tp_tracker_count_before)
-            append_count(results['tracking_tp_additional'], tp_tracker_count_additional)
-            append_count(results['tracking_tp_total'], tp_tracker_count_total)
+        r = result.load_result(result_folder / result.FIRST_SCAN)
+
+        scan_domain = str(urlparse(r[result.ResultKey.SITE_URL]).netloc)
+        # cut off www
+        if scan_domain.startswith('www.'):
+            scan_domain = scan_domain[len('www.'):]
+
+        interaction = r[result.ResultKey.INTERACTION]
+        if len(interaction) != 2:
+            print(f'{result_folder.name} skipped. (unexpected number of interactions: {len(interaction)})')
+            continue
+        analysis_filename = (result_folder / result.FIRST_SCAN)
+        results = analyze_interaction(scan_domain, interaction[0], interaction[1], analysis_filename)
+
+        append_count(results['tp_requests_before'], tp_count_before)
+        append_count(results['tp_requests_additional'], tp_count_additional)
+        append_count(results['tp_requests_total'], tp_count_total)
+        append_count(results['tracking_tp_before'], tp_tracker_count_before)
+        append_count(results['tracking_tp_additional'], tp_tracker_count_additional)
+        append_count(results['tracking_tp_total'], tp_tracker_count_total)
         i += 1
 
     header = ['domain', 'count']
@@ -0,0 +1,158 @@
+import itertools
+
+import pytest
+from podman.errors import NotFound, PodmanError
+
+import podman_container
+from podman_container import PodmanHost
+
+
+class FakeContainer:
+    def __init__(self, container_id, labels, ports):
+        self.id = container_id
+        self.name = f'fake_{container_id}'
+        self.labels = labels
+        self.status = 'running'
+        self.ports = {f'{port}/tcp': [{'HostPort': str(host_port)}] for port, host_port in ports.items()}
+
+    def stop(self, timeout=None):
+        self.status = 'exited'
+
+    def remove(self):
+        pass
+
+
+class FakeContainers:
+    _ids = itertools.count()
+    _host_ports = itertools.count(30000)
+
+    def __init__(self):
+        self.containers = dict()
+
+    def run(self, image, labels, ports, **kwargs):
+        container_id = f'container{next(self._ids)}'
+        container = FakeContainer(container_id, labels,
+                                  {int(port[:-len('/tcp')]): next(self._host_ports) for port in ports})
+        self.containers[container_id] = container
+        return container
+
+    def get(self, container_id):
+        if container_id not in self.containers:
+            raise NotFound(f'no container with id {container_id}')
+        return self.containers[container_id]
+
+    def exists(self, container_id):
+        return container_id in self.containers
+
+    def list(self, filters=None):
+        # only the running containers are listed, like podman without all=True
+        return [c for c in self.containers.values() if c.status == 'running']
+
+
+class FakeImages:
+    def __init__(self, tags):
+        self.tags = set(tags)
+
+    def exists(self, tag):
+        return tag in self.tags
+
+
+class FakePodmanClient:
+    """
+    Stand-in for the subset of the PodmanClient API used by podman_container.
+    """
+
+    def __init__(self, available=True):
+        self.is_available = available
+        self.images = FakeImages(profile.image_tag for profile in podman_container.PROFILES.values())
+        self.containers = FakeContainers()
+
+    def ping(self):
+        return self.is_available
+
+
+def fake_host(name, capacity, available=True):
+    return PodmanHost(name, FakePodmanClient(available), f'{name}.example', capacity)
+
+
+@pytest.fixture
+def hosts(monkeypatch):
+    """
+    Replaces the configured hosts by the returned function, which sets fake hosts.
+    """
+    configured = podman_container.get_hosts()
+    # the fake containers have no devtools endpoint
+    monkeypatch.setattr(podman_container, 'wait_until_ready', lambda address, devtools_port: 0.0)
+
+    def configure(*fake_hosts):
+        podman_container.configure_hosts(fake_hosts)
+        return fake_hosts
+
+    yield configure
+    podman_container.configure_hosts(configured)
+
+
+def test_placement_on_least_loaded_host(hosts):
+    small, large = hosts(fake_host('small', 2), fake_host('large', 4))
+    containers = [podman_container.run_container() for _ in range(3)]
+    # small (0/2), large (0/4), large (1/4 < 1/2)
+    assert [c.address for c in containers] == ['small.example', 'large.example', 'large.example']
+    assert len(small.containers) == 1
+    assert len(large.containers) == 2
+
+
+def test_capacity(hosts):
+    first, second = hosts(fake_host('first', 1), fake_host('second', 1))
+    container = podman_container.run_container()
+    podman_container.run_container()
+    with pytest.raises(PodmanError):
+        podman_container.run_container()
+    podman_container.stop_container(container.id)
+    assert podman_container.run_container().address == container.address
+    assert first.reserved == second.reserved == 0
+
+
+def test_routing_to_owning_host(hosts):
+    first, second = hosts(fake_host('first', 1), fake_host('second', 1))
+    podman_container.run_container()
+    container = podman_container.run_container()
+    assert container.address == 'second.example'
+    assert podman_container.is_running(container.id)
+    podman_container.stop_container(container.id)
+    assert second.client.containers.get(container.id).status == 'exited'
+    assert all(c.status == 'running' for c in first.client.containers.containers.values())
+    assert not podman_container.is_running(container.id)
+
+
+def test_routing_of_unknown_containers(hosts):
+    first, second = hosts(fake_host('first', 1), fake_host('second', 1))
+    container = second.client.containers.run(podman_container.CHROME_IMAGE_TAG, {}, {})
+    # e.g. started before a restart of the manager
+    assert podman_container.is_running(container.id)
+    podman_container.stop_container(container.id)
+    assert container.status == 'exited'
+    with pytest.raises(PodmanError):
+        podman_container.stop_container('unknown')
+
+
+def test_unavailable_host(hosts):
+    unavailable, available = hosts(fake_host('unavailable', 10, available=False), fake_host('available', 1))
+    assert podman_container.podman_available()
+    assert podman_container.run_container().address == 'available.example'
+    with pytest.raises(PodmanError):
+        podman_container.run_container()
+    assert not unavailable.client.containers.containers
+    assert unavailable.reserved == available.reserved == 0
+
+
+def test_reaper_stops_expired_containers_on_their_host(hosts):
+    first, second = hosts(fake_host('first', 1), fake_host('second', 1))
+    expired = podman_container.run_container()
+    running = podman_container.run_container()
+    expired_container = first.client.containers.get(expired.id)
+    expired_container.labels[podman_container.STARTED_AT_LABEL] = '0'
+    podman_container.kill_old_containers()
+    assert expired_container.status == 'exited'
+    assert second.client.containers.get(running.id).status == 'running'
+    assert not first.containers
+    assert second.containers == {running.id}
@@ -0,0 +1,49 @@
+import json
+
+import result_io
+
+
+def cookie(value, partition_key=None, expires=None, timestamp=0):
+    c = {'name': 'id', 'value': value, 'domain': 'example.com', 'path': '/', 'expires': expires,
+         'lifetime': -1 if expires is None else expires - timestamp}
+    if partition_key is not None:
+        c['partitionKey'] = partition_key
+    return c
+
+
+def interaction(timestamp, cookies, requests=()):
+    return {'timestamp': timestamp, 'cookies': cookies, 'fp_cookies': [], 'requests': list(requests)}
+
+
+def round_trip(interactions):
+    result_dict = {'site url': 'https://example.com', result_io.INTERACTION: interactions}
+    # stored as JSON, identities are read back as lists
+    encoded = json.loads(json.dumps(result_io.encode_result(result_dict, 'delta')))
+    return result_io.decode_result(encoded)[result_io.INTERACTION]
+
+
+def test_round_trip():
+    interactions = [interaction(0, [cookie('a'), cookie('b', 'https://x.com')], [{'url': 'https://example.com/'}]),
+                    interaction(5, [cookie('b', 'https://x.com'), cookie('c', expires=100, timestamp=5)],
+                                [{'url': 'https://example.com/'}, {'url': 'https://example.com/a'}]),
+                    interaction(9, [], [])]
+    assert round_trip(interactions) == interactions
+
+
+def test_round_trip_with_duplicate_identities():
+    # cookies sharing name, domain, path and partition, only the second one changes
+    previous = [cookie('v1'), cookie('v2')]
+    current = [cookie('v1'), cookie('v3')]
+    assert round_trip([interaction(0, previous), interaction(1, current)])[1]['cookies'] == current
+
+
+def test_round_trip_with_partitioned_cookies():
+    previous = [cookie('v1', 'a'), cookie('v2', 'b')]
+    current = [cookie('v1', 'a'), cookie('v3', 'b')]
+    assert round_trip([interaction(0, previous), interaction(1, current)])[1]['cookies'] == current
+
+
+def test_round_trip_with_duplicate_requests():
+    requests = [{'url': 'https://example.com/'}, {'url': 'https://example.com/'}]
+    interactions = [interaction(0, [], requests[:1]), interaction(1, [], requests), interaction(2, [], requests[1:])]
+    assert round_trip(interactions) == interactions
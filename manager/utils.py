@@ -4,6 +4,11 @@ import json
 import string
 from contextlib import suppress
 from pathlib import Path
+from urllib.parse import urlparse
+
+import compression
+import profile_store
+import result_io
 
 
 class DirectoryFileHandler:
@@ -66,27 +71,26 @@ def translate_result(path):
     analysis_after = scan_path / "analysis_after"
     analysis_after.mkdir(exist_ok=True)
 
-    with open(result_file, "r") as f:
-        result = json.load(f)
-        interaction = result["interaction"]
-        if len(interaction) != 2:
-            print(f'ERROR, check {path}')
-            return
+    result = result_io.load_result(result_file)
+    interaction = result["interaction"]
+    if len(interaction) != 2:
+        print(f'ERROR, check {path}')
+        return
 
-        url = result['site url']
-        before = interaction[0]
-        store_analysis(url, before, analysis_before)
+    url = result['site url']
+    before = interaction[0]
+    store_analysis(url, before, analysis_before, scan_path)
 
-        after = interaction[1]
-        store_analysis(url, after, analysis_after)
+    after = interaction[1]
+    store_analysis(url, after, analysis_after, scan_path)
 
 
-def store_analysis(url, interaction, path):
+def store_analysis(url, interaction, path, scan_path):
     cookies = interaction['cookies']
     fp_cookies = interaction['fp_cookies']
     cookies_tp = calc_tp_cookies(cookies, fp_cookies)
     requests = interaction['requests']
-    function_calls = interaction['profile']['nodes']
+    function_calls = profile_store.load_interaction_nodes(scan_path, interaction)
     website = {"landingWebsite": url}
 
     store_json(path / 'cookies.json', cookies)
@@ -98,24 +102,47 @@ def store_analysis(url, interaction, path):
 
 def calc_tp_cookies(cookies, cookies_fp):
     # Source: from Consent Guard crawler (scrapers/cookie.js)
-    tp_cookies = list()
-    for c in cookies:
-        if not next((x for x in cookies_fp if compare_cookies(c, x)), None):
-            tp_cookies.append(c)
-    return tp_cookies
+    fp_keys = {cookie_key(c) for c in cookies_fp}
+    return [c for c in cookies if cookie_key(c) not in fp_keys]
+
+
+def cookie_key(cookie):
+    """
+    Returns the key of a cookie in a snapshot, cookies with the same key are the same entry (see calc_tp_cookies).
+    """
+    return cookie['name'], cookie['value'], cookie['domain'], cookie['path']
 
 
-def compare_cookies(c1, c2):
-    return c1['name'] == c2['name'] and \
-           c1['value'] == c2['value'] and \
-           c1['domain'] == c2['domain'] and \
-           c1['path'] == c2['path']
+def cookie_identity(cookie):
+    """
+    Returns the identity of a cookie across snapshots, a cookie with the same identity replaces the previous one
+    (RFC 6265, 5.3), partitioned cookies (CHIPS) are distinct per partition.
+    Used by the delta encoding of the result (see result_io), a changed value is a change of the cookie.
+    """
+    return cookie['name'], cookie['domain'], cookie['path'], cookie.get('partitionKey')
+
+
+def cookie_matches_url(cookie, url):
+    """
+    Returns whether the cookie is sent to the url, i.e. it is a first party cookie of the url.
+    Same filter as playwright's BrowserContext.cookies(urls) (see filterCookies in server/network.ts).
+    """
+    url_parsed = urlparse(url)
+    domain = cookie['domain']
+    if not domain.startswith('.'):
+        domain = '.' + domain
+    if not ('.' + (url_parsed.hostname or '')).endswith(domain):
+        return False
+    if not (url_parsed.path or '/').startswith(cookie['path']):
+        return False
+    if url_parsed.scheme != 'https' and url_parsed.hostname != 'localhost' and cookie['secure']:
+        return False
+    return True
 
 
 def load_json(file_path):
     try:
-        with open(file_path, "r") as f:
-            return json.load(f)
+        return compression.load_json(Path(file_path))
     except Exception:
         return None
 
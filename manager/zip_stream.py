@@ -0,0 +1,76 @@
+import hashlib
+import zipfile
+
+# bytes read from a file at once
+CHUNK_SIZE = 1024 * 1024
+# files that are already compressed, deflating them again only costs time
+STORED_SUFFIXES = ('.gz', '.zst', '.npz', '.png', '.jpg', '.jpeg', '.zip')
+
+
+class _Chunks:
+    """
+    Write-only file object collecting the bytes written by ZipFile.
+    ZipFile writes data descriptors instead of seeking back, since the object has no tell().
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(root):
+    """
+    Yields a ZIP archive of all files below root chunk by chunk, the archive is never stored as a whole.
+    :param root: folder to archive, paths inside the archive are relative to it
+    """
+    yield from stream_files((path, path.relative_to(root)) for path in sorted(root.rglob('*')))
+
+
+def stream_files(files, digests=None, trailer=None):
+    """
+    Yields a ZIP archive of the files chunk by chunk.
+    Files removed while the archive is created (e.g. the journal of a scan that completed) are skipped.
+    :param files: paths and their names inside the archive, folders are skipped
+    :param digests: dict receiving the SHA-256 hex digest of every archived file (by name inside the archive)
+    :param trailer: function returning the name and content of a last file, called once all files are written
+    """
+    chunks = _Chunks()
+    with zipfile.ZipFile(chunks, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, name in files:
+            if not path.is_file():
+                continue
+            try:
+                info = zipfile.ZipInfo.from_file(path, name)
+                src = path.open('rb')
+            except FileNotFoundError:
+                continue
+            digest = hashlib.sha256()
+            with src:
+                info.compress_type = zipfile.ZIP_STORED if path.name.endswith(STORED_SUFFIXES) \
+                    else zipfile.ZIP_DEFLATED
+                with archive.open(info, 'w') as dst:
+                    while block := src.read(CHUNK_SIZE):
+                        digest.update(block)
+                        dst.write(block)
+                        if data := chunks.pop():
+                            yield data
+            if digests is not None:
+                digests[info.filename] = digest.hexdigest()
+            if data := chunks.pop():
+                yield data
+        if trailer is not None:
+            name, content = trailer()
+            archive.writestr(name, content)
+    # central directory
+    yield chunks.pop()